@@ -0,0 +1,137 @@
+# Stand-in for the Domoticz 'DomoticzEx' extension module
+#
+# Just enough of the Extended Python Framework for plugin.py to run outside Domoticz so
+# that message handling can be benchmarked. Nothing is persisted, Unit.Update() and
+# Unit.Touch() only count calls, log output is kept in memory.
+#
+import json
+import time
+
+Devices = {}
+Parameters = {}
+
+LogLines = []
+Echo = False        # Print log lines as well as keeping them
+
+_debugging = 0
+_heartbeat = 10
+_configuration = {}
+
+def _log(level, text):
+    LogLines.append((level, text))
+    if Echo:
+        print(level+": "+text)
+
+def Debugging(level):
+    global _debugging
+    _debugging = level
+
+def Debug(text):
+    if _debugging:
+        _log("Debug", text)
+
+def Log(text):
+    _log("Status", text)
+
+def Status(text):
+    _log("Status", text)
+
+def Error(text):
+    _log("Error", text)
+
+def Dump():
+    _log("Error", "Dump requested")
+
+def Heartbeat(seconds=None):
+    global _heartbeat
+    if seconds is not None:
+        _heartbeat = seconds
+    return _heartbeat
+
+def Configuration(config=None):
+    # Domoticz stores the configuration as JSON in the Hardware table, round trip it to match the cost
+    global _configuration
+    if config is None:
+        return json.loads(json.dumps(_configuration))
+    _configuration = json.loads(json.dumps(config))
+    return config
+
+def Reset():
+    global _debugging, _heartbeat, _configuration
+    Devices.clear()
+    LogLines.clear()
+    _debugging = 0
+    _heartbeat = 10
+    _configuration = {}
+
+class Device:
+    def __init__(self, DeviceID):
+        self.DeviceID = DeviceID
+        self.Units = {}
+        self.TimedOut = 0
+
+class Unit:
+    def __init__(self, Name="", DeviceID="", Unit=0, TypeName="", Type=0, Subtype=0, Switchtype=0, Description="", Used=0, **kwargs):
+        self.Name = Name
+        self.DeviceID = DeviceID
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Description = Description
+        self.Used = Used
+        self.nValue = 0
+        self.sValue = ""
+        self.LastLevel = 0
+        self.Color = ""
+        self.BatteryLevel = 255
+        self.LastUpdate = "1970-01-01 00:00:00"
+        self.Parent = None
+        self.Updates = 0
+        self.Touches = 0
+
+    def Create(self):
+        if self.DeviceID not in Devices:
+            Devices[self.DeviceID] = Device(self.DeviceID)
+        self.Parent = Devices[self.DeviceID]
+        self.Parent.Units[self.Unit] = self
+
+    def Update(self, Log=False, **kwargs):
+        self.Updates += 1
+        self.LastUpdate = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def Touch(self):
+        self.Touches += 1
+        self.LastUpdate = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def Delete(self):
+        if self.Parent is not None:
+            self.Parent.Units.pop(self.Unit, None)
+            if len(self.Parent.Units) == 0:
+                Devices.pop(self.DeviceID, None)
+
+class Connection:
+    def __init__(self, Name="", Transport="", Protocol="", Address="127.0.0.1", Port="1883"):
+        self.Name = Name
+        self.Transport = Transport
+        self.Protocol = Protocol
+        self.Address = Address
+        self.Port = Port
+        self.Sent = []
+        self._connected = True
+
+    def Listen(self):
+        pass
+
+    def Connect(self):
+        self._connected = True
+
+    def Connected(self):
+        return self._connected
+
+    def Disconnect(self):
+        self._connected = False
+
+    def Send(self, Message, Delay=0):
+        self.Sent.append(Message)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Configuration benchmark for the ZWavejs2Mqtt plugin
+#
+# Discovers a synthetic network (300 nodes is roughly 1,300 units) through plugin.py, then compares the
+# version 1 configuration layout (nested dicts plus a topic index) with the current compact version 2
+# layout: stored size, memory held once loaded and the time to load it at start.
+#
+# Usage:
+#   python3 benchmark/config.py
+#   python3 benchmark/config.py --nodes 1000
+#
+import argparse
+import gc
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import replay
+
+def legacyConfiguration(plugin):
+    # The version 1 layout, as written before the mappings became records
+    config = {"devices": {}, "topics": {}}
+    for deviceID, theDevice in plugin.deviceMappings.items():
+        deviceDict = config["devices"][deviceID] = {"units": {}}
+        for theMapping in theDevice.mappings():
+            valueDict = {"mapped_type": theMapping.mappedType, "reported_type": theMapping.reportedType}
+            valueDict.update(theMapping.topics)
+            for key, attribute in theMapping.discoveryFields:
+                if getattr(theMapping, attribute) is not None:
+                    valueDict[key] = getattr(theMapping, attribute)
+            if theMapping.unitNum > 0:
+                deviceDict["units"][str(theMapping.unitNum)] = valueDict
+            else:
+                deviceDict[theMapping.mappedType] = valueDict
+            for topic in theMapping.stateTopics():
+                if theMapping.unitNum > 0:
+                    config["topics"][topic] = {"deviceID": deviceID, "unit": str(theMapping.unitNum)}
+                else:
+                    config["topics"][topic] = {"deviceID": deviceID, "mapped_type": theMapping.mappedType}
+    return config
+
+def bestTime(action, rounds):
+    best = None
+    for round in range(rounds):
+        started = time.perf_counter()
+        action()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None or elapsed < best else best
+    return best
+
+def heldMemory(action):
+    # Memory still allocated once 'action' has run and its result is kept
+    gc.collect()
+    tracemalloc.start()
+    result = action()
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return held, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare configuration layouts for a large network")
+    parser.add_argument("--nodes", type=int, default=300, help="synthetic network size")
+    parser.add_argument("--rounds", type=int, default=5, help="timing rounds, the best is reported")
+    args = parser.parse_args()
+
+    homeFolder = tempfile.mkdtemp(prefix="zwavejs2mqtt-benchmark-")+os.sep
+    try:
+        plugin = replay.loadPlugin(homeFolder)
+        network = replay.Replay(plugin, 1000)
+        network.run(replay.syntheticDiscovery(args.nodes))
+        network.stop()
+        thePlugin = plugin._plugin
+        units = sum(len(theDevice.mappings()) for theDevice in thePlugin.deviceMappings.values())
+
+        legacyText = json.dumps(legacyConfiguration(thePlugin))
+        currentText = json.dumps(thePlugin.configurationToSave())
+        print("Network: "+str(args.nodes)+" nodes, "+str(units)+" mapped units, "+str(len(thePlugin.topicMappings))+" state topics")
+
+        def loadLegacy():
+            return json.loads(legacyText)
+        def migrateLegacy():
+            thePlugin.loadConfiguration(json.loads(legacyText))
+        def loadCurrent():
+            thePlugin.loadConfiguration(json.loads(currentText))
+
+        # Version 1 was used as loaded, the mappings replace the parsed configuration which is then freed
+        thePlugin.deviceMappings = thePlugin.topicMappings = None
+        legacyHeld, legacyConfig = heldMemory(loadLegacy)
+        del legacyConfig
+        currentHeld, ignored = heldMemory(loadCurrent)
+
+        print("  {:<34}{:>12}{:>14}{:>12}".format("layout", "stored KiB", "held KiB", "load ms"))
+        print("  {:<34}{:>12.1f}{:>14.1f}{:>12.2f}".format("version 1 (nested dicts)", len(legacyText)/1024, legacyHeld/1024, bestTime(loadLegacy, args.rounds)*1000))
+        print("  {:<34}{:>12}{:>14}{:>12.2f}".format("version 1 migrated at start", "", "", bestTime(migrateLegacy, args.rounds)*1000))
+        print("  {:<34}{:>12.1f}{:>14.1f}{:>12.2f}".format("version 2 (slotted records)", len(currentText)/1024, currentHeld/1024, bestTime(loadCurrent, args.rounds)*1000))
+    finally:
+        shutil.rmtree(homeFolder, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Payload decoding benchmark for the ZWavejs2Mqtt plugin
+#
+# Compares the plugin's 'JSON Time-Value' decoder (DecodeTimeValue) with the general json.loads
+# path it replaced on the telemetry part of a capture or the synthetic network from replay.py.
+#
+# Usage:
+#   python3 benchmark/decode.py
+#   python3 benchmark/decode.py --capture "MQTT Messages.jsonl"
+#
+import argparse
+import json
+import time
+
+import replay
+
+def jsonDecode(payload):
+    # What synchroniseData did before: parse, then pick the fields out of the dict
+    jsonDict = json.loads(payload)
+    eventTime = int(jsonDict["time"]) if ("time" in jsonDict) else None
+    value = jsonDict["value"] if ("value" in jsonDict) else None
+    return eventTime, value
+
+def timeDecoder(decoder, payloads, rounds):
+    best = None
+    for round in range(rounds):
+        started = time.perf_counter()
+        for payload in payloads:
+            decoder(payload)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None or elapsed < best else best
+    return best
+
+class CountingJson:
+    # Stands in for the plugin's json module to count payloads that needed the general parser
+    def __init__(self):
+        self.calls = 0
+
+    def loads(self, payload):
+        self.calls += 1
+        return json.loads(payload)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time 'JSON Time-Value' payload decoding")
+    parser.add_argument("--capture", help="'Write to file' capture to use instead of synthetic traffic")
+    parser.add_argument("--nodes", type=int, default=120, help="synthetic network size")
+    parser.add_argument("--reports", type=int, default=10, help="synthetic telemetry rounds per node")
+    parser.add_argument("--rounds", type=int, default=5, help="timing rounds, the best is reported")
+    args = parser.parse_args()
+
+    if args.capture:
+        messages = replay.readCapture(args.capture)
+        source = args.capture
+    else:
+        messages = replay.syntheticTelemetry(args.nodes, args.reports)
+        source = "synthetic, "+str(args.nodes)+" nodes"
+    payloads = []
+    for topic, payload, qos in messages:
+        if topic.startswith("domoticz"):
+            continue
+        try:
+            if isinstance(json.loads(payload), dict):
+                payloads.append(payload)
+        except ValueError:
+            pass
+    print("Source: "+source+", "+str(len(payloads))+" telemetry payloads")
+    if len(payloads) == 0:
+        return
+
+    plugin = replay.loadPlugin("")
+    counter = CountingJson()
+    plugin.json = counter
+    for payload in payloads:
+        plugin.DecodeTimeValue(payload)
+    plugin.json = json
+    print("  Fast path:   {:.1f}% of payloads, {:,} fell back to json.loads".format(100.0*(len(payloads)-counter.calls)/len(payloads), counter.calls))
+
+    baseline = timeDecoder(jsonDecode, payloads, args.rounds)
+    decoder = timeDecoder(plugin.DecodeTimeValue, payloads, args.rounds)
+    print("  json.loads:      {:8.3f} us/payload".format(baseline/len(payloads)*1e6))
+    print("  DecodeTimeValue: {:8.3f} us/payload ({:.2f}x)".format(decoder/len(payloads)*1e6, baseline/decoder if decoder > 0 else 0))
+
+if __name__ == "__main__":
+    main()
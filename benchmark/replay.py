@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# Offline replay benchmark for the ZWavejs2Mqtt plugin
+#
+# Runs plugin.py against the stand-in DomoticzEx module in this folder and drives onMessage
+# with either recorded traffic or a synthetic network, reporting throughput, per handler
+# latency (by mapped_type) and peak memory for a discovery storm and steady state telemetry.
+#
+# Usage:
+#   python3 benchmark/replay.py                                 synthetic network, 120 nodes
+#   python3 benchmark/replay.py --nodes 500 --reports 20
+#   python3 benchmark/replay.py --capture "MQTT Messages.jsonl" captured with 'Write to file'
+#   python3 benchmark/replay.py --pipeline                      decode on the pipeline worker thread
+#
+import argparse
+import ast
+import importlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+benchmarkFolder = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, benchmarkFolder)
+sys.path.insert(1, os.path.dirname(benchmarkFolder))
+
+import DomoticzEx as Domoticz
+
+HOME_ID = "0xe0779f52"
+
+# Entities published per node: (component, mapped type, topic suffix, command topic suffix)
+PLUG_ENTITIES = [
+    ("light", "dimmer", "38/0/currentValue", "38/0/targetValue/set"),
+    ("sensor", "electric_w_value", "50/0/value/66049", None),
+    ("sensor", "electric_kwh_value", "50/0/value/65537", None),
+    ("sensor", "electric_a_value", "50/0/value/66817", None),
+    ("sensor", "electric_v_value", "50/0/value/66561", None),
+]
+SENSOR_ENTITIES = [
+    ("binary_sensor", "motion_sensor_status", "113/0/Home_Security/Motion_sensor_status", None),
+    ("sensor", "temperature_air", "49/0/Air_temperature", None),
+    ("sensor", "humidity_air", "49/0/Humidity", None),
+    ("sensor", "illuminance", "49/0/Illuminance", None),
+    ("sensor", "battery_level", "128/0/level", None),
+]
+SWITCH_ENTITIES = [
+    ("switch", "switch", "37/0/currentValue", "37/0/targetValue/set"),
+    ("sensor", "electric_w_value", "50/0/value/66049", None),
+    ("sensor", "electric_kwh_value", "50/0/value/65537", None),
+]
+NODE_TEMPLATES = [PLUG_ENTITIES, SENSOR_ENTITIES, SWITCH_ENTITIES]
+
+# Topics zwavejs2mqtt publishes that have no discovery entry
+UNMAPPED_SUFFIXES = ["128/0/isLow", "132/0/wakeUpInterval", "114/0/manufacturerId", "50/0/value/65793"]
+
+def compactJson(value):
+    return json.dumps(value, separators=(",", ":")).encode()
+
+def nodeEntities(node):
+    return NODE_TEMPLATES[node % len(NODE_TEMPLATES)]
+
+def syntheticDiscovery(nodes):
+    messages = []
+    for node in range(2, nodes+2):
+        deviceName = "Node_"+str(node)
+        device = {"identifiers": ["zwavejs2mqtt_"+HOME_ID+"_node"+str(node)], "manufacturer": "Benchmark", "model": "Synthetic", "name": deviceName}
+        for component, mappedType, suffix, commandSuffix in nodeEntities(node):
+            payload = {"name": deviceName+"_"+mappedType, "state_topic": "zwave/"+str(node)+"/"+suffix, "device": device}
+            if commandSuffix is not None:
+                payload["command_topic"] = "zwave/"+str(node)+"/"+commandSuffix
+            if mappedType == "switch":
+                payload["payload_on"] = True
+                payload["payload_off"] = False
+            if mappedType == "dimmer":
+                payload["brightness_scale"] = 99
+            messages.append(("domoticz/"+component+"/"+deviceName+"/"+mappedType+"/config", compactJson(payload), 1))
+    return messages
+
+def syntheticValue(mappedType, rand):
+    if mappedType == "dimmer": return rand.randint(0, 99)
+    if mappedType == "switch": return rand.random() < 0.5
+    if mappedType == "motion_sensor_status": return rand.choice([0, 8])
+    if mappedType == "battery_level": return rand.choice([90, 90, 90, 89])
+    if mappedType == "humidity_air": return rand.randint(40, 60)
+    if mappedType == "illuminance": return rand.randint(0, 500)
+    if mappedType == "temperature_air": return round(rand.uniform(19.0, 23.0), 1)
+    if mappedType == "electric_kwh_value": return round(rand.uniform(100.0, 101.0), 3)
+    if mappedType == "electric_v_value": return round(rand.uniform(228.0, 242.0), 1)
+    if mappedType == "electric_a_value": return round(rand.uniform(0.0, 2.0), 2)
+    return round(rand.uniform(0.0, 400.0), 2)
+
+def syntheticTelemetry(nodes, reports, seed=1):
+    # Meters report three times as often as everything else, as smart plugs do
+    rand = random.Random(seed)
+    messages = []
+    eventTime = int(time.time()*1000)
+    for report in range(reports):
+        for node in range(2, nodes+2):
+            for component, mappedType, suffix, commandSuffix in nodeEntities(node):
+                repeats = 3 if mappedType.startswith("electric_") and (mappedType != "electric_kwh_value") else 1
+                for repeat in range(repeats):
+                    eventTime += 5
+                    messages.append(("zwave/"+str(node)+"/"+suffix, compactJson({"time": eventTime, "value": syntheticValue(mappedType, rand)}), 1))
+            suffix = UNMAPPED_SUFFIXES[(node+report) % len(UNMAPPED_SUFFIXES)]
+            eventTime += 5
+            messages.append(("zwave/"+str(node)+"/"+suffix, compactJson({"time": eventTime, "value": rand.randint(0, 10)}), 1))
+    return messages
+
+def readCapture(fileName):
+    # Accepts the JSON lines written by 'Write to file' and the older 'topic: payload' text format
+    messages = []
+    with open(fileName, "r", encoding="utf-8", errors="replace") as captureFile:
+        for line in captureFile:
+            line = line.rstrip("\n")
+            if len(line) == 0:
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+                messages.append((entry["topic"], entry["payload"].encode(), entry.get("qos", 1)))
+            else:
+                topic, separator, payload = line.partition(": ")
+                if separator == "":
+                    continue
+                if payload.startswith("b'") or payload.startswith('b"'):
+                    payload = ast.literal_eval(payload)
+                else:
+                    payload = payload.encode()
+                messages.append((topic, payload, 1))
+    return messages
+
+def loadPlugin(homeFolder, debug=False, pipeline=False):
+    Domoticz.Reset()
+    Domoticz.Parameters.clear()
+    Domoticz.Parameters.update({"Address": "127.0.0.1", "Port": "1883", "Username": "", "Password": "",
+                                "Mode1": "", "Mode2": "", "Mode3": "", "Mode4": "True" if pipeline else "False", "Mode5": "False",
+                                "Mode6": "Debug" if debug else "Normal", "HomeFolder": homeFolder})
+    if "plugin" in sys.modules:
+        plugin = importlib.reload(sys.modules["plugin"])
+    else:
+        plugin = importlib.import_module("plugin")
+    # Domoticz injects these into the plugin module
+    plugin.Devices = Domoticz.Devices
+    plugin.Parameters = Domoticz.Parameters
+    return plugin
+
+def percentile(sortedTimes, fraction):
+    return sortedTimes[min(len(sortedTimes)-1, int(len(sortedTimes)*fraction))]
+
+class Replay:
+    def __init__(self, plugin, heartbeatEvery):
+        self.plugin = plugin
+        self.heartbeatEvery = heartbeatEvery
+        self.connection = Domoticz.Connection(Name="Benchmark", Address="127.0.0.1", Port="50000")
+        self.packetIdentifier = 0
+        self.plugin.onStart()
+        self.plugin.onConnect(self.connection, 0, "")
+        self.plugin.onMessage(self.connection, {"Verb": "CONNECT", "Version": 4, "ClientIdentifier": "zwavejs2mqtt-benchmark", "KeepAlive": 60})
+
+    def handlerName(self, topic):
+        if topic.startswith("domoticz"):
+            return "discovery"
+        theRoute = self.plugin._plugin.topicRoutes.get(topic)
+        return theRoute.mappedType if theRoute is not None else "unmapped"
+
+    def run(self, messages, timings=None):
+        clock = time.perf_counter
+        started = clock()
+        for index, (topic, payload, qos) in enumerate(messages):
+            self.packetIdentifier = (self.packetIdentifier % 65535) + 1
+            data = {"Verb": "PUBLISH", "Topic": topic, "Payload": payload, "QoS": qos, "Retain": False, "Duplicate": False, "PacketIdentifier": self.packetIdentifier}
+            before = clock()
+            self.plugin.onMessage(self.connection, data)
+            elapsed = clock() - before
+            if timings is not None:
+                timings.setdefault(self.handlerName(topic), []).append(elapsed)
+            if (index+1) % self.heartbeatEvery == 0:
+                self.heartbeat(timings)
+        self.heartbeat(timings, quiet=True)
+        return clock() - started
+
+    def heartbeat(self, timings, quiet=False):
+        if quiet:
+            # The gateway has gone quiet, let the discovery quiet period pass so the batch is handled by this heartbeat
+            thePlugin = self.plugin._plugin
+            thePlugin.discoveryLast = time.monotonic() - thePlugin.discoveryQuiet
+        before = time.perf_counter()
+        self.plugin.onHeartbeat()
+        if timings is not None:
+            timings.setdefault("(heartbeat)", []).append(time.perf_counter() - before)
+
+    def stop(self):
+        self.plugin.onStop()
+
+def unitActivity():
+    updates = touches = 0
+    for device in Domoticz.Devices.values():
+        for unit in device.Units.values():
+            updates += unit.Updates
+            touches += unit.Touches
+    return updates, touches
+
+def runScenario(name, setup, measured, args, homeFolder):
+    # Timing pass then a separate pass under tracemalloc for peak memory
+    plugin = loadPlugin(homeFolder, args.debug, args.pipeline)
+    replay = Replay(plugin, args.heartbeat_every)
+    if setup: replay.run(setup)
+    baseUpdates, baseTouches = unitActivity()
+    timings = {}
+    elapsed = replay.run(measured, timings)
+    updates, touches = unitActivity()
+    replay.stop()
+    errors = [line for level, line in Domoticz.LogLines if level == "Error"]
+
+    peak = None
+    if not args.no_memory:
+        plugin = loadPlugin(homeFolder, args.debug, args.pipeline)
+        tracemalloc.start()
+        replay = Replay(plugin, args.heartbeat_every)
+        if setup: replay.run(setup)
+        tracemalloc.reset_peak()
+        replay.run(measured)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        replay.stop()
+
+    print("")
+    print("Scenario: "+name+" ("+str(len(measured))+" messages)")
+    print("  Throughput:  {:,.0f} msg/s ({:.3f} s)".format(len(measured)/elapsed if elapsed > 0 else 0, elapsed))
+    if peak is not None:
+        print("  Peak memory: {:,.1f} KiB".format(peak/1024))
+    print("  Unit Update() calls: {:,}, Touch() calls: {:,}, errors logged: {:,}".format(updates-baseUpdates, touches-baseTouches, len(errors)))
+    print("  {:<24}{:>8}{:>10}{:>10}{:>10}{:>10}".format("handler", "count", "p50 us", "p90 us", "p99 us", "max us"))
+    for handler in sorted(timings, key=lambda key: -sum(timings[key])):
+        times = sorted(timings[handler])
+        print("  {:<24}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(handler, len(times), percentile(times, 0.5)*1e6,
+              percentile(times, 0.9)*1e6, percentile(times, 0.99)*1e6, times[-1]*1e6))
+    for line in errors[:5]:
+        print("  error: "+line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay MQTT traffic through plugin.py without Domoticz")
+    parser.add_argument("--capture", help="'Write to file' capture to replay instead of synthetic traffic")
+    parser.add_argument("--nodes", type=int, default=120, help="synthetic network size")
+    parser.add_argument("--reports", type=int, default=10, help="synthetic telemetry rounds per node")
+    parser.add_argument("--heartbeat-every", type=int, default=1000, help="messages between onHeartbeat calls")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--debug", action="store_true", help="run with Mode6 set to Debug")
+    parser.add_argument("--pipeline", action="store_true", help="run with pipeline mode (Mode4) enabled")
+    args = parser.parse_args()
+
+    if args.capture:
+        messages = readCapture(args.capture)
+        discovery = [message for message in messages if message[0].startswith("domoticz")]
+        telemetry = [message for message in messages if not message[0].startswith("domoticz")]
+        source = args.capture
+    else:
+        discovery = syntheticDiscovery(args.nodes)
+        telemetry = syntheticTelemetry(args.nodes, args.reports)
+        source = "synthetic, "+str(args.nodes)+" nodes"
+    print("Source: "+source+", "+str(len(discovery))+" discovery and "+str(len(telemetry))+" telemetry messages")
+
+    homeFolder = tempfile.mkdtemp(prefix="zwavejs2mqtt-benchmark-")+os.sep
+    try:
+        if len(discovery) > 0:
+            runScenario("discovery storm", None, discovery, args, homeFolder)
+            runScenario("gateway reconnect (repeat discovery)", discovery, discovery, args, homeFolder)
+        if len(telemetry) > 0:
+            runScenario("steady state telemetry", discovery, telemetry, args, homeFolder)
+    finally:
+        shutil.rmtree(homeFolder, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
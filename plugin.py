@@ -54,6 +54,12 @@
         </param>
         <param field="Username" label="Username" width="200px"/>
         <param field="Password" label="Password" width="200px" password=true/>
+        <param field="Mode4" label="Pipeline mode" width="75px">
+            <options>
+                <option label="True" value="True"/>
+                <option label="False" value="False"  default="true" />
+            </options>
+        </param>
         <param field="Mode5" label="Write to file" width="75px">
             <options>
                 <option label="True" value="True"/>
@@ -70,9 +76,524 @@
 </plugin>
 """
 import DomoticzEx as Domoticz
+import array
 import json
 import os,sys
-from datetime import datetime
+import re
+import collections
+import hashlib
+import queue
+import threading
+import time
+
+class TopicRoute:
+    # Everything needed to apply a state topic message, resolved once rather than per message
+    __slots__ = ("deviceID", "unitNum", "unit", "mappedType", "update", "payloadOn", "brightnessScale", "lastTime",
+                 "coalesce", "writtenValue", "lastWrite", "pendingValue", "pendingSvalue", "touchInterval", "lastTouch",
+                 "history", "aggregate", "lastAggregate")
+
+    def __init__(self, deviceID, unitNum, unit, mappedType, update, unitConfig=None, coalesce=None, touchInterval=0, history=None, aggregate=None):
+        self.deviceID = deviceID
+        self.unitNum = unitNum
+        self.unit = unit
+        self.mappedType = mappedType
+        self.update = update
+        self.payloadOn = unitConfig.payloadOn if (unitConfig != None) and (unitConfig.payloadOn != None) else True
+        self.brightnessScale = unitConfig.brightnessScale if (unitConfig != None) and (unitConfig.brightnessScale != None) else 99
+        self.lastTime = None    # Gateway timestamp (ms) of the last event applied, seeded from LastUpdate on first use
+
+        # Meter coalescing (only when the type or unit configures it)
+        self.coalesce = coalesce
+        self.writtenValue = None
+        self.lastWrite = 0.0
+        self.pendingValue = None
+        self.pendingSvalue = None
+
+        # Unchanged reports only Touch() the unit once per 'touchInterval' seconds
+        self.touchInterval = touchInterval
+        self.lastTouch = 0.0
+
+        # Raw readings of numeric units (a ReadingHistory) and, when the type aggregates them, the aggregate settings
+        self.history = history
+        self.aggregate = aggregate
+        self.lastAggregate = 0.0
+
+class ReadingHistory:
+    # The last 'size' raw readings of a numeric unit in two arrays used as a ring buffer (allocated with the first reading)
+    # and running totals of the readings since the unit was last written for its aggregate
+    __slots__ = ("size", "times", "values", "next", "count", "windowCount", "windowSum", "windowMin", "windowMax", "windowLast", "windowTime")
+
+    def __init__(self, size):
+        self.size = size
+        self.times = None       # Gateway time (ms)
+        self.values = None
+        self.next = 0
+        self.count = 0
+        self.windowCount = 0
+
+    def add(self, eventTime, value):
+        if (self.values == None):
+            self.times = array.array("d", [0.0]) * self.size
+            self.values = array.array("d", [0.0]) * self.size
+        self.times[self.next] = eventTime
+        self.values[self.next] = value
+        self.next = (self.next + 1) % self.size
+        if (self.count < self.size): self.count += 1
+
+        if (self.windowCount == 0):
+            self.windowSum = 0.0
+            self.windowMin = self.windowMax = value
+        elif (value < self.windowMin):
+            self.windowMin = value
+        elif (value > self.windowMax):
+            self.windowMax = value
+        self.windowCount += 1
+        self.windowSum += value
+        self.windowLast = value
+        self.windowTime = eventTime
+
+    def aggregate(self, function):
+        # (time of the last reading, aggregate) of the readings since the last call, None if there were none
+        if (self.windowCount == 0):
+            return None
+        if (function == "mean"):
+            theValue = round(self.windowSum / self.windowCount, 2)
+        elif (function == "min"):
+            theValue = self.windowMin
+        elif (function == "max"):
+            theValue = self.windowMax
+        else:
+            theValue = self.windowLast
+        self.windowCount = 0
+        return (self.windowTime, theValue)
+
+    def recent(self, limit=None):
+        # [[time, value]] oldest first
+        first = (self.next - self.count) % self.size if (self.count > 0) else 0
+        readings = [[int(self.times[(first + index) % self.size]), self.values[(first + index) % self.size]] for index in range(self.count)]
+        return readings[-limit:] if (limit != None) else readings
+
+class UnitMapping:
+    # What discovery reported for one entity, either a Domoticz unit or (unitNum 0) a device level value such as battery
+    __slots__ = ("deviceID", "unitNum", "mappedType", "reportedType", "topics", "payloadOn", "payloadOff", "onCommandType",
+                 "brightnessScale", "coalesce")
+
+    # Discovery attributes kept as well as the topics: (discovery/configuration key, attribute)
+    discoveryFields = (("payload_on", "payloadOn"), ("payload_off", "payloadOff"), ("on_command_type", "onCommandType"),
+                       ("brightness_scale", "brightnessScale"))
+
+    def __init__(self, deviceID, unitNum, mappedType, reportedType):
+        self.deviceID = deviceID
+        self.unitNum = unitNum
+        self.mappedType = mappedType
+        self.reportedType = reportedType
+        self.topics = {}                # Every '*_topic' entry from discovery, names and topics interned
+        self.payloadOn = None           # None when discovery did not supply the attribute
+        self.payloadOff = None
+        self.onCommandType = None
+        self.brightnessScale = None
+        self.coalesce = None            # Meter coalescing override: None for the type default, False to disable it
+
+    def stateTopics(self):
+        return [self.topics[name] for name in self.topics if (name.find("state_topic") != -1)]
+
+    def update(self, jsonDict):
+        # Copy the interesting parts of a discovery payload, True if anything changed
+        changed = False
+        for entry in jsonDict:
+            if (entry.find("_topic") != -1) and (isinstance(jsonDict[entry], str)) and (self.topics.get(entry) != jsonDict[entry]):
+                self.topics[sys.intern(entry)] = sys.intern(jsonDict[entry])
+                changed = True
+        for key, attribute in self.discoveryFields:
+            if (key in jsonDict) and (getattr(self, attribute) != jsonDict[key]):
+                setattr(self, attribute, jsonDict[key])
+                changed = True
+        return changed
+
+    def toConfiguration(self, prefix):
+        # Compact form: [unit, mapped type, reported type, {topic name less '_topic': topic less device prefix}, {attributes}]
+        topics = {}
+        for name in self.topics:
+            topics[name[:-6] if name.endswith("_topic") else name] = self.topics[name][len(prefix):]
+        entry = [self.unitNum, self.mappedType, self.reportedType, topics]
+        attributes = {}
+        for key, attribute in self.discoveryFields:
+            if (getattr(self, attribute) != None): attributes[key] = getattr(self, attribute)
+        if (self.coalesce != None): attributes["coalesce"] = self.coalesce if (self.coalesce != False) else None
+        if (len(attributes) > 0): entry.append(attributes)
+        return entry
+
+    @staticmethod
+    def fromConfiguration(deviceID, entry, prefix):
+        theMapping = UnitMapping(deviceID, entry[0], sys.intern(entry[1]), sys.intern(entry[2]))
+        for name in entry[3]:
+            theMapping.topics[sys.intern(name if (name.find("_topic") != -1) else name+"_topic")] = sys.intern(prefix+entry[3][name])
+        if (len(entry) > 4):
+            theMapping.update(entry[4])
+            if ("coalesce" in entry[4]): theMapping.coalesce = entry[4]["coalesce"] if (entry[4]["coalesce"] != None) else False
+        return theMapping
+
+class DeviceMapping:
+    # Mappings for one zwavejs2mqtt node: Domoticz units by number and device level values by mapped type
+    __slots__ = ("deviceID", "units", "deviceLevel", "clientID")
+
+    def __init__(self, deviceID):
+        self.deviceID = deviceID
+        self.units = {}
+        self.deviceLevel = {}
+        self.clientID = None        # MQTT client ID of the gateway that discovered it, commands only go there
+
+    def mappings(self):
+        return list(self.units.values()) + list(self.deviceLevel.values())
+
+class GatewayClient:
+    # An MQTT client (normally a zwavejs2mqtt instance) by client ID, kept across reconnects for its statistics and, when it
+    # connects without Clean Session, its MQTT session
+    __slots__ = ("clientID", "connection", "homeIDs", "received", "discovery", "commands", "dropped", "connections",
+                 "cleanSession", "sessionStored", "subscriptions", "pending", "queued", "expired", "reaped")
+
+    def __init__(self, clientID):
+        self.clientID = clientID
+        self.connection = None      # 'address:port' while connected
+        self.homeIDs = set()        # Z-Wave networks seen in its device identifiers
+        self.received = 0
+        self.discovery = 0
+        self.commands = 0
+        self.dropped = 0            # Commands for its devices while it was not connected
+        self.connections = 0
+        self.reaped = 0             # Connections closed for exceeding the keep alive
+
+        # Session state
+        self.cleanSession = True
+        self.sessionStored = False  # A session is kept for the next connection
+        self.subscriptions = {}     # Topic filter -> granted QoS
+        self.pending = collections.deque()  # (topic, payload, QoS) held while it is not connected, oldest first
+        self.queued = 0
+        self.expired = 0            # Held messages discarded because too many were waiting
+
+    def clearSession(self):
+        self.sessionStored = False
+        self.subscriptions = {}
+        self.pending.clear()
+
+    def subscribedQoS(self, topic):
+        # Highest QoS granted for the topic by the session's subscriptions, None if not subscribed
+        theQoS = None
+        for topicFilter in self.subscriptions:
+            if (SubscriptionTree.filterMatches(topicFilter, topic)):
+                theQoS = max(theQoS, self.subscriptions[topicFilter]) if (theQoS != None) else self.subscriptions[topicFilter]
+        return theQoS
+
+    def snapshot(self, devices):
+        return {"connected":(self.connection != None), "connection":self.connection, "homeIDs":sorted(self.homeIDs), "devices":devices,
+                "received":self.received, "discovery":self.discovery, "commands":self.commands, "dropped":self.dropped, "connections":self.connections, "reaped":self.reaped,
+                "session":(not self.cleanSession), "subscriptions":len(self.subscriptions), "pending":len(self.pending), "queued":self.queued, "expired":self.expired}
+
+class TimeValue:
+    # A decoded 'JSON Time-Value' payload, what the updaters receive instead of the parsed dict
+    __slots__ = ("time", "value", "hasValue")
+
+    def __init__(self, time, value, hasValue):
+        self.time = time
+        self.value = value
+        self.hasValue = hasValue
+
+    def __repr__(self):
+        return "{'time': "+str(self.time)+(", 'value': "+repr(self.value) if self.hasValue else "")+"}"
+
+class PluginLog:
+    # Level gated logging, messages are only formatted if they are going to be written
+    def __init__(self):
+        self.debugging = False
+        self.unitInterval = 300     # Seconds between routine 'updated'/'seen' lines for a unit
+        self.unitLastLogged = {}
+
+    def debug(self, message, *args):
+        if (self.debugging):
+            Domoticz.Debug(message.format(*args) if args else message)
+
+    def log(self, message, *args):
+        Domoticz.Log(message.format(*args) if args else message)
+
+    def error(self, message, *args):
+        Domoticz.Error(message.format(*args) if args else message)
+
+    def unitLog(self, key, message, *args):
+        # Rate limited per key so chatty units don't flood the log, unlimited when debugging
+        now = time.monotonic()
+        if (not self.debugging):
+            lastLogged = self.unitLastLogged.get(key)
+            if (lastLogged != None) and (now - lastLogged < self.unitInterval):
+                return
+        self.unitLastLogged[key] = now
+        Domoticz.Log(message.format(*args) if args else message)
+
+class MessageCapture:
+    # Buffered capture of MQTT traffic as JSON lines, written out on heartbeat and rotated by size and age
+    def __init__(self, fileName, maxBytes=5000000, maxAge=86400, maxFiles=5, maxBuffered=5000, sampleRate=1, topicFilters=None):
+        self.fileName = fileName
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge            # Seconds before the current file is rotated regardless of size
+        self.maxFiles = maxFiles        # Rotated files retained, oldest are deleted
+        self.maxBuffered = maxBuffered  # Flush early if this many messages arrive between heartbeats
+        self.sampleRate = sampleRate    # Capture 1 in N messages
+        self.topicFilters = topicFilters
+        self.buffer = []
+        self.sampleCount = 0
+        self.captured = 0
+        self.file = None
+        self.fileSize = 0
+        self.fileOpened = 0.0
+
+    def capture(self, client, topic, qos, payload):
+        if (self.topicFilters != None):
+            for topicFilter in self.topicFilters:
+                if (topic.startswith(topicFilter)): break
+            else:
+                return
+        if (self.sampleRate > 1):
+            self.sampleCount += 1
+            if (self.sampleCount % self.sampleRate != 0): return
+        # Formatting is deferred until the buffer is flushed
+        self.buffer.append((int(time.time()*1000), client, topic, qos, payload))
+        if (len(self.buffer) >= self.maxBuffered):
+            self.flush()
+
+    def flush(self):
+        if (len(self.buffer) == 0):
+            return
+        lines = []
+        for received, client, topic, qos, payload in self.buffer:
+            lines.append(json.dumps({"received":received, "client":client, "topic":topic, "qos":qos, "payload":Utf8(payload)}))
+        self.captured += len(self.buffer)
+        self.buffer = []
+        try:
+            if (self.file == None) or (self.fileSize >= self.maxBytes) or (time.monotonic() - self.fileOpened >= self.maxAge):
+                self.rotate()
+            data = "\n".join(lines)+"\n"
+            self.file.write(data)
+            self.file.flush()
+            self.fileSize += len(data)
+        except OSError as err:
+            Domoticz.Error("MQTT capture write to '"+self.fileName+"' failed: "+str(err))
+
+    def rotate(self):
+        if (self.file != None):
+            self.file.close()
+            self.file = None
+        if (os.path.exists(self.fileName)) and ((self.fileOpened != 0.0) or (os.path.getsize(self.fileName) >= self.maxBytes)):
+            for index in range(self.maxFiles-1, 0, -1):
+                if (os.path.exists(self.fileName+"."+str(index))):
+                    os.replace(self.fileName+"."+str(index), self.fileName+"."+str(index+1))
+            os.replace(self.fileName, self.fileName+".1")
+            if (os.path.exists(self.fileName+"."+str(self.maxFiles+1))):
+                os.remove(self.fileName+"."+str(self.maxFiles+1))
+        self.file = open(self.fileName, "a")
+        self.fileSize = self.file.tell()
+        self.fileOpened = time.monotonic()
+
+    def close(self):
+        self.flush()
+        if (self.file != None):
+            self.file.close()
+            self.file = None
+
+class PluginMetrics:
+    # Always on counters and timing histograms for the message path, cheap enough to leave running
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)     # Upper bounds in seconds, last bucket is everything slower
+
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+        self.started = time.time()
+        self.lastSummaryCount = 0
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def timing(self, name, seconds):
+        # [count, total, max, bucket counts]
+        theTiming = self.timings.get(name)
+        if (theTiming == None):
+            theTiming = self.timings[name] = [0, 0.0, 0.0, [0]*(len(self.BUCKETS)+1)]
+        theTiming[0] += 1
+        theTiming[1] += seconds
+        if (seconds > theTiming[2]): theTiming[2] = seconds
+        for index, bound in enumerate(self.BUCKETS):
+            if (seconds <= bound):
+                theTiming[3][index] += 1
+                break
+        else:
+            theTiming[3][len(self.BUCKETS)] += 1
+
+    def summary(self):
+        messages = self.counters.get("verb.PUBLISH", 0)
+        text = "Messages: "+str(messages)+" (+"+str(messages-self.lastSummaryCount)+")"
+        self.lastSummaryCount = messages
+        text += ", data: "+str(self.counters.get("topic.data", 0))+", discovery: "+str(self.counters.get("topic.discovery", 0))
+        text += ", unknown: "+str(self.counters.get("unknown_topics", 0))+", stale: "+str(self.counters.get("stale_events", 0))
+        text += ", JSON errors: "+str(self.counters.get("json_errors", 0))
+        text += ", Update(): "+str(self.counters.get("unit.update", 0))+", Touch(): "+str(self.counters.get("unit.touch", 0))
+        text += " (skipped "+str(self.counters.get("unit.touch_skipped", 0))+")"
+        for name in sorted(self.timings):
+            theTiming = self.timings[name]
+            text += ", "+name+" avg/max: {:.0f}/{:.0f}us".format(theTiming[1]/theTiming[0]*1e6, theTiming[2]*1e6)
+        return text
+
+    def snapshot(self):
+        timings = {}
+        for name in self.timings:
+            theTiming = self.timings[name]
+            buckets = {}
+            for index, bound in enumerate(self.BUCKETS):
+                buckets["<="+str(bound)] = theTiming[3][index]
+            buckets[">"+str(self.BUCKETS[-1])] = theTiming[3][len(self.BUCKETS)]
+            timings[name] = {"count":theTiming[0], "total":theTiming[1], "max":theTiming[2], "buckets":buckets}
+        return {"since":int(self.started), "written":int(time.time()), "counters":dict(self.counters), "timings":timings}
+
+class SubscriptionNode:
+    __slots__ = ("children", "subscribers")
+
+    def __init__(self):
+        self.children = {}
+        self.subscribers = {}   # client -> granted QoS
+
+class SubscriptionTree:
+    # MQTT topic filters held as a trie on topic levels so matching costs O(topic depth), supports '+' and '#'
+    def __init__(self):
+        self.root = SubscriptionNode()
+        self.clientFilters = {}     # client -> {topic filter: granted QoS}
+
+    @staticmethod
+    def validFilter(topicFilter):
+        levels = topicFilter.split("/")
+        for index, level in enumerate(levels):
+            if (level == "#") and (index != len(levels)-1): return False
+            if (len(level) > 1) and (("#" in level) or ("+" in level)): return False
+        return (len(topicFilter) > 0)
+
+    def subscribe(self, client, topicFilter, qos):
+        node = self.root
+        for level in topicFilter.split("/"):
+            child = node.children.get(level)
+            if (child == None):
+                child = node.children[level] = SubscriptionNode()
+            node = child
+        node.subscribers[client] = qos
+        self.clientFilters.setdefault(client, {})[topicFilter] = qos
+
+    def unsubscribe(self, client, topicFilter):
+        path = [self.root]
+        levels = topicFilter.split("/")
+        for level in levels:
+            child = path[-1].children.get(level)
+            if (child == None): return False
+            path.append(child)
+        if (path[-1].subscribers.pop(client, None) == None): return False
+        self.clientFilters.get(client, {}).pop(topicFilter, None)
+        # Prune branches that no longer lead to a subscriber
+        for index in range(len(levels), 0, -1):
+            node = path[index]
+            if (len(node.subscribers) > 0) or (len(node.children) > 0): break
+            path[index-1].children.pop(levels[index-1], None)
+        return True
+
+    def removeClient(self, client):
+        for topicFilter in list(self.clientFilters.get(client, {})):
+            self.unsubscribe(client, topicFilter)
+        self.clientFilters.pop(client, None)
+
+    def match(self, topic):
+        # Returns {client: QoS} using the highest QoS where several filters of a client match
+        matches = {}
+        self.matchLevel(self.root, topic.split("/"), 0, matches)
+        return matches
+
+    def matchLevel(self, node, levels, index, matches):
+        wildcard = node.children.get("#")
+        if (wildcard != None): self.addMatches(wildcard, matches)   # Also matches the parent level, 'a/#' matches 'a'
+        if (index == len(levels)):
+            self.addMatches(node, matches)
+            return
+        child = node.children.get(levels[index])
+        if (child != None): self.matchLevel(child, levels, index+1, matches)
+        child = node.children.get("+")
+        if (child != None): self.matchLevel(child, levels, index+1, matches)
+
+    @staticmethod
+    def filterMatches(topicFilter, topic):
+        # Single filter check, used where there is no tree to walk (retained messages)
+        filterLevels = topicFilter.split("/")
+        topicLevels = topic.split("/")
+        for index, level in enumerate(filterLevels):
+            if (level == "#"): return True
+            if (index >= len(topicLevels)): return False
+            if (level != "+") and (level != topicLevels[index]): return False
+        return (len(filterLevels) == len(topicLevels))
+
+    @staticmethod
+    def addMatches(node, matches):
+        for client, qos in node.subscribers.items():
+            if (matches.get(client, -1) < qos):
+                matches[client] = qos
+
+class InFlightWindow:
+    # QoS 1 messages sent to a client but not yet acknowledged, beyond 'maxInFlight' messages are queued
+    def __init__(self, maxInFlight=10, retryInterval=20, maxRetries=3):
+        self.maxInFlight = maxInFlight
+        self.retryInterval = retryInterval  # Seconds before an unacknowledged message is sent again
+        self.maxRetries = maxRetries
+        self.nextIdentifier = 1
+        self.inFlight = {}                  # PacketIdentifier -> [message, last sent, attempts]
+        self.queued = collections.deque()
+
+    def allocateIdentifier(self):
+        # 1-65535, skipping identifiers still in flight
+        while True:
+            identifier = self.nextIdentifier
+            self.nextIdentifier = (identifier % 65535) + 1
+            if (not identifier in self.inFlight):
+                return identifier
+
+    def submit(self, message):
+        # Returns the message to send now or None if it has been queued
+        if (len(self.inFlight) >= self.maxInFlight):
+            self.queued.append(message)
+            return None
+        return self.track(message)
+
+    def track(self, message):
+        message["PacketIdentifier"] = self.allocateIdentifier()
+        self.inFlight[message["PacketIdentifier"]] = [message, time.monotonic(), 1]
+        return message
+
+    def acknowledge(self, identifier):
+        # Returns the queued messages that can now be sent
+        if (self.inFlight.pop(identifier, None) == None):
+            return []
+        released = []
+        while (len(self.queued) > 0) and (len(self.inFlight) < self.maxInFlight):
+            released.append(self.track(self.queued.popleft()))
+        return released
+
+    def expired(self):
+        # Returns (messages to send again, messages given up on)
+        now = time.monotonic()
+        resend = []
+        failed = []
+        for identifier in list(self.inFlight):
+            entry = self.inFlight[identifier]
+            if (now - entry[1] >= self.retryInterval):
+                if (entry[2] > self.maxRetries):
+                    failed.append(self.inFlight.pop(identifier)[0])
+                    continue
+                entry[0]["Duplicate"] = True
+                entry[1] = now
+                entry[2] += 1
+                resend.append(entry[0])
+        while (len(self.queued) > 0) and (len(self.inFlight) < self.maxInFlight):
+            resend.append(self.track(self.queued.popleft()))
+        return resend, failed
 
 class BasePlugin:
     
@@ -80,66 +601,132 @@ class BasePlugin:
         self.enabled = False
         self.mqttListener = None
         self.mqttClients = {}
-        self.mqttLogFile = None
+        self.subscriptions = SubscriptionTree()
+        self.inFlight = {}      # Client -> InFlightWindow for QoS 1 messages sent to it
+
+        #   Gateways by MQTT client ID and the client ID of each connection. Devices are tagged with the gateway that
+        #   discovered them so commands are only sent to that gateway when several share the plugin. Clients that connect
+        #   without a client ID are known by their connection ('anonymousClients'), never tag devices and are forgotten
+        #   when they disconnect
+        self.gateways = {}
+        self.clientIDs = {}
+        self.anonymousClients = set()
+
+        #   Clients that connect without Clean Session keep their subscriptions while disconnected and QoS 1 messages for
+        #   them are held, oldest first, up to 'sessionQueueLimit' (the oldest are discarded beyond that) and delivered
+        #   when they reconnect. Sessions are not kept across plugin restarts
+        self.sessionQueueLimit = 100
+
+        #   Keep alive: connection -> [time of last message, keep alive seconds from CONNECT or None before it]. A client
+        #   silent for 'keepAliveGrace' times its keep alive (or 'connectTimeout' seconds without a CONNECT) is disconnected
+        #   and forgotten so nothing more is sent to it, checked every heartbeat and before publishing to it
+        self.clientActivity = {}
+        self.keepAliveGrace = 1.5
+        self.connectTimeout = 30
+
+        #   Last value received per state topic [raw payload, value, gateway time] and retained messages [payload, QoS],
+        #   both saved to 'Last Values.json' at stop and reloaded at start
+        self.lastValues = {}
+        self.retainedMessages = {}
+
+        #   Battery level per device as last written to its units, reports that move it by less than
+        #   'batteryHysteresis' percent are ignored
+        self.batteryLevels = {}
+        self.batteryHysteresis = 2
+
+        #   Slider commands: the first is sent straight away, later ones within 'commandWindow' seconds replace
+        #   each other and only the last is sent when the window closes (checked on every callback)
+        self.commandWindow = 0.5
+        self.pendingCommands = {}   # Topic -> [payload, due, deviceID]
+
+        #   Heartbeat interval, Domoticz's default unless a held command (or pipeline mode) needs 'fastHeartbeat'
+        self.heartbeatInterval = 10
+        self.normalHeartbeat = 10
+        self.fastHeartbeat = 1
+        self.lastCommandSent = {}   # Topic -> time last sent
+        self.mqttCapture = None
         self.counter = 0
+        self.log = PluginLog()
+
+        #   Runtime metrics, summarised every 'metricsInterval' seconds to the log, a Text unit and a file
+        self.metrics = PluginMetrics()
+        self.metricsInterval = 300
+        self.lastMetrics = time.monotonic()
+        self.metricsDeviceID = "Zwavejs2Mqtt Plugin"
 
-        # Configuration structure:
+        #   Discovered mappings, DeviceID -> DeviceMapping and state topic -> UnitMapping. Saved with Domoticz.Configuration
+        #   in a compact versioned form (see configurationToSave), one entry per device:
         #    {
+        #        "version": 2,
         #        "devices":
         #        {
-        #            "zwavejs2mqtt_0xe0779f52_node3":
+        #            "zwavejs2mqtt_0xe0779f52_node5":
         #            {
-        #               "units":
-        #               {
-        #                   1:
-        #                   {
-        #                       "mapped_type": "scene_state_scene_001",
-        #                       "reported_type": "sensor",
-        #                       "state_topic": "zwave/5/38/0/currentValue",
-        #                       "command_topic": "zwave/5/38/0/targetValue/set",
-        #                       "on_command_type": "brightness"
-        #                       "payload_on": true,
-        #                       "payload_off": false
-        #                   }
-        #                   2:
-        #                   {
-        #                       ...
-        #                   }
-        #               }
-        #               "battery":
-        #               {
-        #                   "state_topic": "zwave/5/38/0/level",
-        #                   "reported_type": "sensor",
-        #                   "mapped_type": "battery_level"
-        #               }
+        #                "prefix": "zwave/5/",
+        #                "units":
+        #                [
+        #                    [1, "dimmer", "light", {"state": "38/0/currentValue", "command": "38/0/targetValue/set"}, {"brightness_scale": 99}],
+        #                    [0, "battery_level", "sensor", {"state": "128/0/level"}]
+        #                ]
         #            }
         #        }
-        #       "topics": 
-        #       {
-        #           "zwave/3/91/0/scene/001": 
-        #           {
-        #               "deviceID": "zwavejs2mqtt_0xe0779f52_node3",
-        #               "unit": "1"
-        #           },
-        #           "zwave/3/128/0/level":
-        #           {
-        #               "deviceID": "zwavejs2mqtt_0xe0779f52_node3",
-        #               "mapped_type": "battery_level"
-        #           },
-        #       }
         #    }
-        #
-        self.pluginConfig = None
+        #   Version 1 configurations (nested dicts keyed by unit number strings plus a 'topics' index) are migrated at start.
+        self.deviceMappings = {}
+        self.topicMappings = {}
+        self.configVersion = 2
+
+        #   State topics of units deleted in Domoticz, kept in memory only. Messages on them are dropped and repeats of the
+        #   discovery already seen are ignored, new or changed discovery for the topic clears it and maps the unit again
+        self.removedTopics = set()
+
+        #   Changes to the mappings are written behind, once per heartbeat and at stop
+        self.configDirty = False
+        self.configWritesSaved = 0
+
+        #   Routing table, state topic -> TopicRoute. Built at start and kept current by discovery
+        self.topicRoutes = {}
+
+        #   Discovery de-duplication: a fingerprint (16 byte BLAKE2b digest) of each discovery payload handled
+        self.discoveryFingerprints = {}
+
+        #   Discovery batching: messages are collected (latest per topic) and handled together, grouped by device, once none
+        #   has arrived for 'discoveryQuiet' seconds, 'discoveryMaxWait' seconds after the first or when 'discoveryBatchLimit'
+        #   are waiting. State messages for topics still waiting ('discoveryPending') are held, in order, and applied once
+        #   the batch has been handled, the batch is handled early if 'discoveryHeldLimit' are held
+        self.discoveryBatch = {}        # Topic -> (decoded payload, fingerprint, client ID)
+        self.discoveryPending = set()
+        self.discoveryHeld = []         # (Topic, Payload)
+        self.discoveryHeldLimit = 5000
+        self.discoveryStarted = 0.0
+        self.discoveryLast = 0.0
+        self.discoveryQuiet = 2
+        self.discoveryMaxWait = 30
+        self.discoveryBatchLimit = 5000
+
+        #   Meter units that hold back readings, flushed from onHeartbeat
+        self.pendingMeters = set()
+        self.meterWritesHeld = 0
 
         #   Type mapping:
+        #       'coalesce' limits database writes for chatty meters, readings are written when they move outside
+        #       the deadband (larger of 'absolute' and 'relative' * last written value) and 'interval' seconds
+        #       have passed since the last write. Readings inside the deadband are written after 'hold' seconds.
+        #       Can be overridden per unit with a 'coalesce' entry in the unit's plugin configuration.
+        #       'touchInterval' replaces the default minimum seconds between Touch() calls for unchanged values.
+        #       'aggregate' combines readings into one write per 'interval' seconds, see 'historySize' below.
         self.typeMapping = {
                     "any":                      {"type": "Contact", "update": self.updateBinarySensor },
                     "dimmer":                   {"type": "Dimmer", "update": self.updateDimmer, "command": self.commandDimmer },
-                    "electric_a_value":         {"type": "Current/Ampere", "suffix":"Current", "defaultSvalue":"0;0.0;0.0", "update": self.updateCurrent },
-                    "electric_v_value":         {"type": "Voltage", "defaultSvalue":"0", "update": self.updateSensor },
-                    "electric_w_value":         {"type": "Usage", "defaultSvalue":"0.000", "update": self.updateUsage },
+                    "electric_a_value":         {"type": "Current/Ampere", "suffix":"Current", "defaultSvalue":"0;0.0;0.0", "update": self.updateCurrent,
+                                                 "coalesce": {"absolute":0.05, "relative":0.05, "interval":30, "hold":300} },
+                    "electric_v_value":         {"type": "Voltage", "defaultSvalue":"0", "update": self.updateSensor,
+                                                 "coalesce": {"absolute":2.0, "relative":0.01, "interval":30, "hold":300} },
+                    "electric_w_value":         {"type": "Usage", "defaultSvalue":"0.000", "update": self.updateUsage,
+                                                 "coalesce": {"absolute":1.0, "relative":0.05, "interval":30, "hold":300} },
                     "electric_kwh_value":       {"type": (113,0,0), "suffix":"kWh", "defaultSvalue":"0000", "update": self.updatekWh },
-                    "electricity_power":        {"type": "Usage", "defaultSvalue":"0.000", "update": self.updateUsage },
+                    "electricity_power":        {"type": "Usage", "defaultSvalue":"0.000", "update": self.updateUsage,
+                                                 "coalesce": {"absolute":1.0, "relative":0.05, "interval":30, "hold":300} },
                     "home_security":            {"type": "Contact", "update": self.updateBinarySensor },
                     "rgb_dimmer":               {"type": (241,2,7), "suffix":"RGB Dimmer", "update": self.updateColor, "command": self.commandColor },
                     "scene_state_scene_001":    {"type": "Push On", "suffix":"Scene 1", "update": self.updateScene },
@@ -157,19 +744,56 @@ class BasePlugin:
                     "motion_sensor_status":     {"type": "Motion", "suffix":"PIR", "update": self.updateBinarySensor },
                     "door_state":               {"type": "Contact", "suffix":"Door State", "update": self.updateBinarySensor },
                     "cover_status":             {"type": "Contact", "suffix":"Tamper", "update": self.updateBinarySensor },
-                    "illuminance":              {"type": "Illumination", "suffix":"Lux", "update": self.updateSensor },
-                    "temperature_air":          {"type": "Temperature", "update": self.updateSensor },
-                    "humidity_air":             {"type": "Percentage", "update": self.updateSensor },
-                    "sun_ultraviolet":          {"type": "UV", "update": self.updateUltraviolet }
+                    "illuminance":              {"type": "Illumination", "suffix":"Lux", "update": self.updateSensor,
+                                                 "aggregate": {"function":"last", "interval":60} },
+                    "temperature_air":          {"type": "Temperature", "update": self.updateSensor,
+                                                 "aggregate": {"function":"mean", "interval":60} },
+                    "humidity_air":             {"type": "Percentage", "update": self.updateSensor,
+                                                 "aggregate": {"function":"mean", "interval":60} },
+                    "sun_ultraviolet":          {"type": "UV", "update": self.updateUltraviolet,
+                                                 "aggregate": {"function":"max", "interval":60} }
                     }
 
+        #   Pipeline mode ('Pipeline mode' parameter): state messages are looked up, decoded and checked for a change of value
+        #   on a worker thread. The plugin thread never waits for it, each callback applies at most 'pipelineBatch' results
+        #   that are ready and leaves the rest for the next one (the heartbeat is shortened to 'fastHeartbeat' seconds so
+        #   none wait long). Unchanged values skip the updater. When the queue is full the message is dropped and counted
+        self.pipelineWorker = None
+        self.pipelineQueue = None           # (Topic, Payload) to the worker
+        self.pipelineResults = None         # (Topic, Payload, route, decoded payload, time of the same value before) back from it
+        self.pipelinePending = 0            # Queued and not yet applied
+        self.pipelinePeak = 0
+        self.pipelineSize = 1000
+        self.pipelineBatch = 10
+
+        #   Numeric units keep their last 'historySize' raw readings in memory (written to 'Reading History.json' with the
+        #   metrics when debugging). A type with 'aggregate' settings is not written for every reading: the first after
+        #   'interval' seconds is written straight away, later ones are combined ('function' is last, mean, min or max)
+        #   and written once the interval has passed, checked every heartbeat. Aggregated units are not coalesced
+        self.historySize = 60
+        self.historyUpdates = frozenset([self.updateCurrent, self.updateSensor, self.updateUsage, self.updateUltraviolet, self.updatekWh])
+        self.aggregatedRoutes = set()
+
+        #   Unchanged values only Touch() a unit (a database write) once every 'touchInterval' seconds, a type can override
+        #   this with its own 'touchInterval'. Capped at 'touchIntervalLimit', well inside Domoticz's sensor timeout
+        self.touchInterval = 60
+        self.touchIntervalLimit = 300
+
         #   Special handling (device level)
         self.specialHandling = {
             "battery_level": { "update": self.updateBattery }
             }
 
         #   Don't even log some topics to make logging useful
-        self.completelyIgnore = "isLow,wakeUpInterval,controllerNodeId,version,manufacturerId,productType,productId,libraryType,protocolVersion,firmwareVersions"
+        self.completelyIgnore = frozenset(["isLow", "wakeUpInterval", "controllerNodeId", "version", "manufacturerId", "productType", "productId",
+                                           "libraryType", "protocolVersion", "firmwareVersions"])
+
+        #   Topics with no mapping, topic -> messages dropped since the last metrics report. Checked before the payload is
+        #   decoded, an entry is removed when discovery maps its topic
+        self.unmappedTopics = {}
+
+        #   MQTT traffic capture ('Write to file'), see MessageCapture. 'topicFilters' is a list of topic prefixes or None for everything
+        self.captureSettings = {"maxBytes":5000000, "maxAge":86400, "maxFiles":5, "sampleRate":1, "topicFilters":None}
 
     def commandColor(self, cmdUnit, Command, Level, Hue):
         # commandColor called: Lava Lamp_rgb_dimmer, Command: Set Color, Level: 1, Hue: {"b":113,"cw":0,"g":255,"m":3,"r":192,"t":0,"ww":0}
@@ -177,7 +801,7 @@ class BasePlugin:
         # commandColor called: Lava Lamp_rgb_dimmer, Command: Set Color, Level: 45, Hue: {"b":113,"cw":0,"g":255,"m":3,"r":192,"t":0,"ww":0}
         Domoticz.Log("commandColor called: "+cmdUnit.Name+", Command: "+Command+", Level: "+str(Level)+", Hue: "+str(Hue))
 
-        # self.publishChange(theTopic,thePayload)
+        # Set Color and Set Level should use self.publishCoalesced(theTopic,thePayload)
 
     def commandDimmer(self, cmdUnit, Command, Level, Hue):
         # commandDimmer called: Office Dimmer, Command: On, Level: 0, Hue:          <-- turn on
@@ -192,22 +816,24 @@ class BasePlugin:
             Domoticz.Error("Dimmer command failed for "+cmdUnit.Name+", unable to find configuration.")
             return
 
-        if (not "command_topic" in unitConfig): 
+        if (not "command_topic" in unitConfig.topics): 
             Domoticz.Error("Dimmer command failed for "+cmdUnit.Name+", No command topic mapped.")
             return
-        theTopic = unitConfig["command_topic"]
+        theTopic = unitConfig.topics["command_topic"]
 
         # Create the payload based on the command
         if (Command == "Set Level"):
-            maxBrightness = unitConfig["brightness_scale"] if ("brightness_scale" in unitConfig) else 99
+            maxBrightness = unitConfig.brightnessScale if (unitConfig.brightnessScale != None) else 99
             theBrightness = Level * (maxBrightness/99) if (Level * (maxBrightness/99) <= maxBrightness) else maxBrightness
             thePayload = str(int(theBrightness))
-            if ("brightness_command_topic" in unitConfig):  # On/Off and Brightness topics can be the same but use the specific one if it is available
-                theTopic = unitConfig["brightness_command_topic"]
+            if ("brightness_command_topic" in unitConfig.topics):  # On/Off and Brightness topics can be the same but use the specific one if it is available
+                theTopic = unitConfig.topics["brightness_command_topic"]
+            self.publishCoalesced(theTopic,thePayload,cmdUnit.Parent.DeviceID)
         else:
-            thePayload = Command
-
-        self.publishChange(theTopic,thePayload)
+            # On/Off goes immediately and a level still waiting to be sent would undo it
+            self.pendingCommands.pop(theTopic, None)
+            if ("brightness_command_topic" in unitConfig.topics): self.pendingCommands.pop(unitConfig.topics["brightness_command_topic"], None)
+            self.publishChange(theTopic,Command,cmdUnit.Parent.DeviceID)
 
     def commandBinarySwitch(self, cmdUnit, Command, Level, Hue):
         # commandBinarySwitch called: Bedside Lamp_switch, Command: Off, Level: 0
@@ -219,118 +845,233 @@ class BasePlugin:
             Domoticz.Error("Switch command failed for "+cmdUnit.Name+", unable to find configuration.")
             return
 
-        if (not "command_topic" in unitConfig): 
+        if (not "command_topic" in unitConfig.topics): 
             Domoticz.Error("Switch command failed for "+cmdUnit.Name+", No command topic mapped.")
             return
-        theTopic = unitConfig["command_topic"]
+        theTopic = unitConfig.topics["command_topic"]
 
         if Command == "On":
-            thePayload = "{'value':"+str(unitConfig["payload_on"])+"}" if "payload_on" in unitConfig else "{'value':True}"
+            thePayload = "{'value':"+str(unitConfig.payloadOn)+"}" if (unitConfig.payloadOn != None) else "{'value':True}"
         else:
-            thePayload = "{'value':"+str(unitConfig["payload_off"])+"}" if "payload_on" in unitConfig else "{'value':False}"
+            thePayload = "{'value':"+str(unitConfig.payloadOff)+"}" if (unitConfig.payloadOff != None) else "{'value':False}"
         Domoticz.Debug("commandBinarySwitch: Found topic: "+theTopic+", Payload is: "+thePayload)
 
-        self.publishChange(theTopic,thePayload)
+        self.publishChange(theTopic,thePayload,cmdUnit.Parent.DeviceID)
 
-    def performUpdate(self, unitObj, updateRequired, forceLog=False):
+    def performUpdate(self, theRoute, updateRequired, forceLog=False):
+        unitObj = theRoute.unit
+        now = time.monotonic()
         if (updateRequired):
             unitObj.Update(Log=forceLog)
-            if (unitObj.Used > 0): Domoticz.Log("'"+unitObj.Name+"' updated ("+str(unitObj.nValue)+", '"+unitObj.sValue+"')")
+            theRoute.lastTouch = now
+            self.metrics.count("unit.update")
+            if (unitObj.Used > 0):
+                if (forceLog):
+                    self.log.log("'{}' updated ({}, '{}')", unitObj.Name, unitObj.nValue, unitObj.sValue)
+                else:
+                    self.log.unitLog(id(unitObj), "'{}' updated ({}, '{}')", unitObj.Name, unitObj.nValue, unitObj.sValue)
+        elif (now - theRoute.lastTouch < theRoute.touchInterval):
+            # Unchanged and Domoticz was told recently enough
+            self.metrics.count("unit.touch_skipped")
         else:
             unitObj.Touch()
-            if (unitObj.Used > 0): Domoticz.Log("'"+unitObj.Name+"' seen  ("+str(unitObj.nValue)+", '"+unitObj.sValue+"')")
+            theRoute.lastTouch = now
+            self.metrics.count("unit.touch")
+            if (unitObj.Used > 0): self.log.unitLog(id(unitObj), "'{}' seen  ({}, '{}')", unitObj.Name, unitObj.nValue, unitObj.sValue)
+
+    def updateBattery(self, theRoute, theEvent):
+        # Device level, held once per device and only written to its units when it moves by 'batteryHysteresis' or more
+        if (not theEvent.hasValue) or (not isinstance(theEvent.value, (int, float))): return
+        theLevel = int(theEvent.value)
+        lastLevel = self.batteryLevels.get(theRoute.deviceID)
+        if (lastLevel != None) and (abs(theLevel - lastLevel) < self.batteryHysteresis):
+            self.metrics.count("battery.unchanged")
+            return
+        self.batteryLevels[theRoute.deviceID] = theLevel
+
+        # Single pass over the device, units already showing the level are left alone
+        theUnits = Devices[theRoute.deviceID].Units
+        changed = [theUnits[unit] for unit in theUnits if (theUnits[unit].BatteryLevel != theLevel)]
+        for unitObj in changed:
+            unitObj.BatteryLevel = theLevel
+            unitObj.Update()
+        if (len(changed) > 0):
+            self.metrics.count("unit.update", len(changed))
+            self.log.debug("updateBattery: {}, {} units set to {}%", theRoute.deviceID, len(changed), theLevel)
+
+    def meterUpdate(self, theRoute, theValue, sValue):
+        # Applies a meter reading, coalescing it if the route is configured to
+        unitObj = theRoute.unit
+        settings = theRoute.coalesce
+        if (settings == None):
+            oldValue = unitObj.sValue
+            unitObj.sValue = sValue
+            self.performUpdate(theRoute, (unitObj.sValue != oldValue))
+            return
 
-    def updateBattery(self, unitObj, jsonDict):
-        if ('value' in jsonDict):
-            if (unitObj.BatteryLevel != jsonDict['value']):
-                unitObj.BatteryLevel = jsonDict['value']
-                unitObj.Update()
-            Domoticz.Debug("updateBattery: "+unitObj.Name+", Payload: "+str(jsonDict))
+        if (sValue == unitObj.sValue):
+            # Same as what is already written so nothing to hold
+            self.pendingMeters.discard(theRoute)
+            theRoute.pendingValue = theRoute.pendingSvalue = None
+            self.performUpdate(theRoute, False)
+            return
 
-    def updateCurrent(self, unitObj, jsonDict):
+        now = time.monotonic()
+        if (theRoute.writtenValue == None) or \
+                ((now - theRoute.lastWrite >= settings["interval"]) and self.outsideDeadband(theRoute, theValue)):
+            self.writeMeter(theRoute, theValue, sValue, now)
+        else:
+            if (theRoute.pendingSvalue != None):
+                self.meterWritesHeld += 1
+            theRoute.pendingValue = theValue
+            theRoute.pendingSvalue = sValue
+            self.pendingMeters.add(theRoute)
+
+    def outsideDeadband(self, theRoute, theValue):
+        settings = theRoute.coalesce
+        deadband = max(settings["absolute"], abs(theRoute.writtenValue) * settings["relative"])
+        return (abs(theValue - theRoute.writtenValue) > deadband)
+
+    def writeMeter(self, theRoute, theValue, sValue, now):
+        self.pendingMeters.discard(theRoute)
+        theRoute.pendingValue = theRoute.pendingSvalue = None
+        theRoute.writtenValue = theValue
+        theRoute.lastWrite = now
+        theRoute.unit.sValue = sValue
+        self.performUpdate(theRoute, True)
+
+    def flushMeters(self, force=False):
+        # Write held meter readings whose interval (or hold time inside the deadband) has expired
+        if (len(self.pendingMeters) == 0):
+            return
+        now = time.monotonic()
+        for theRoute in list(self.pendingMeters):
+            settings = theRoute.coalesce
+            due = settings["interval"] if self.outsideDeadband(theRoute, theRoute.pendingValue) else settings["hold"]
+            if (force) or (now - theRoute.lastWrite >= due):
+                self.writeMeter(theRoute, theRoute.pendingValue, theRoute.pendingSvalue, now)
+        self.log.debug("Meter coalescing: {} held, {} writes avoided so far", len(self.pendingMeters), self.meterWritesHeld)
+
+    def recordReading(self, theRoute, theEvent):
+        # Keep a numeric reading in the unit's history, True if the unit is aggregated and the reading is only written as part of its aggregate
+        theValue = theEvent.value
+        if (not theEvent.hasValue) or (not isinstance(theValue, (int, float))) or (isinstance(theValue, bool)):
+            return False
+        theRoute.history.add(theEvent.time, theValue)
+        if (theRoute.aggregate == None):
+            return False
+        self.metrics.count("aggregate.readings")
+        if (time.monotonic() - theRoute.lastAggregate >= theRoute.aggregate["interval"]):
+            self.writeAggregate(theRoute)
+        else:
+            self.aggregatedRoutes.add(theRoute)
+        return True
+
+    def writeAggregate(self, theRoute):
+        self.aggregatedRoutes.discard(theRoute)
+        theRoute.lastAggregate = time.monotonic()
+        theAggregate = theRoute.history.aggregate(theRoute.aggregate["function"])
+        if (theAggregate != None):
+            self.metrics.count("aggregate.writes")
+            theRoute.update(theRoute, TimeValue(int(theAggregate[0]), theAggregate[1], True))
+
+    def flushAggregates(self, force=False):
+        # Write the aggregates of units whose interval has passed
+        if (len(self.aggregatedRoutes) == 0):
+            return
+        now = time.monotonic()
+        for theRoute in [theRoute for theRoute in self.aggregatedRoutes if (force) or (now - theRoute.lastAggregate >= theRoute.aggregate["interval"])]:
+            self.writeAggregate(theRoute)
+
+    def dumpHistory(self):
+        # Recent raw readings of every numeric unit, for troubleshooting
+        theHistory = {}
+        for topic in self.topicRoutes:
+            theRoute = self.topicRoutes[topic]
+            if (theRoute.history != None) and (theRoute.history.count > 0):
+                theHistory[topic] = {"unit":theRoute.deviceID+"\\"+str(theRoute.unitNum), "name":theRoute.unit.Name, "type":theRoute.mappedType,
+                                     "readings":theRoute.history.recent()}
+        try:
+            with open(Parameters["HomeFolder"]+"Reading History.json", "w") as historyFile:
+                json.dump(theHistory, historyFile, indent=1)
+            Domoticz.Debug("Reading history written for "+str(len(theHistory))+" units.")
+        except OSError as err:
+            Domoticz.Error("Unable to write reading history: "+str(err))
+
+    def updateCurrent(self, theRoute, theEvent):
+        unitObj = theRoute.unit
         # Complicated, sValue only '0.0;0.0;0.0'
-        if ('value' in jsonDict):
-            oldValue = unitObj.sValue
-            unitObj.sValue = str(jsonDict['value'])+';0.0;0.0'
-            self.performUpdate(unitObj, (unitObj.sValue != oldValue))
-            Domoticz.Debug("updateCurrent: "+unitObj.Name+", Payload: "+str(jsonDict))
+        if (theEvent.hasValue):
+            self.meterUpdate(theRoute, theEvent.value, str(theEvent.value)+';0.0;0.0')
+            self.log.debug("updateCurrent: {}, Payload: {}", unitObj.Name, theEvent)
 
-    def updateSensor(self, unitObj, jsonDict):
+    def updateSensor(self, theRoute, theEvent):
+        unitObj = theRoute.unit
         # Simply stored in sValue
-        if ('value' in jsonDict):
-            oldValue = unitObj.sValue
-            unitObj.sValue = str(jsonDict['value'])
-            self.performUpdate(unitObj, (unitObj.sValue != oldValue))
-            Domoticz.Debug("updateSensor: "+unitObj.Name+", Payload: "+str(jsonDict))
+        if (theEvent.hasValue):
+            self.meterUpdate(theRoute, theEvent.value, str(theEvent.value))
+            self.log.debug("updateSensor: {}, Payload: {}", unitObj.Name, theEvent)
 
-    def updateUsage(self, unitObj, jsonDict):
+    def updateUsage(self, theRoute, theEvent):
+        unitObj = theRoute.unit
         # Stored in sValue to a minimum of 3 decimal places
-        if ('value' in jsonDict):
-            oldValue = unitObj.sValue
-            unitObj.sValue = "{:.3f}".format(jsonDict['value'])
-            self.performUpdate(unitObj, (unitObj.sValue != oldValue))
-            Domoticz.Debug("updateUsage: "+unitObj.Name+", Payload: "+str(jsonDict))
+        if (theEvent.hasValue):
+            self.meterUpdate(theRoute, theEvent.value, "{:.3f}".format(theEvent.value))
+            self.log.debug("updateUsage: {}, Payload: {}", unitObj.Name, theEvent)
 
-    def updateUltraviolet(self, unitObj, jsonDict):
+    def updateUltraviolet(self, theRoute, theEvent):
+        unitObj = theRoute.unit
         # Stored in sValue to a minimum of 3 decimal places
-        if ('value' in jsonDict):
+        if (theEvent.hasValue):
             oldValue = unitObj.sValue
-            unitObj.sValue = "{:.1f}".format(jsonDict['value'])+";0.0"
-            self.performUpdate(unitObj, (unitObj.sValue != oldValue))
-            Domoticz.Debug("updateUltraviolet: "+unitObj.Name+", Payload: "+str(jsonDict))
+            unitObj.sValue = "{:.1f}".format(theEvent.value)+";0.0"
+            self.performUpdate(theRoute, (unitObj.sValue != oldValue))
+            self.log.debug("updateUltraviolet: {}, Payload: {}", unitObj.Name, theEvent)
 
-    def updatekWh(self, unitObj, jsonDict):
+    def updatekWh(self, theRoute, theEvent):
+        unitObj = theRoute.unit
         # sValue only.  '10180123'  KwH -> '10180.123'
         # Note: Number of decimal places provided can vary
-        if ('value' in jsonDict):
+        if (theEvent.hasValue):
             oldValue = unitObj.sValue
-            jsonDict['value'] = "{:.3f}".format(jsonDict['value'])  # Force 3 trailing decimal places
-            unitObj.sValue = str(jsonDict['value']).replace(".","") # Remove the decimal place (Domoticz will put it back in)
-            self.performUpdate(unitObj, (unitObj.sValue != oldValue))
-            Domoticz.Debug("updatekWh: "+unitObj.Name+", Payload: "+str(jsonDict))
+            theValue = "{:.3f}".format(theEvent.value)      # Force 3 trailing decimal places
+            unitObj.sValue = theValue.replace(".","")       # Remove the decimal place (Domoticz will put it back in)
+            self.performUpdate(theRoute, (unitObj.sValue != oldValue))
+            self.log.debug("updatekWh: {}, Payload: {}", unitObj.Name, theEvent)
 
-    def updateDimmer(self, unitObj, jsonDict):
+    def updateDimmer(self, theRoute, theEvent):
         # nValue maps to:
         #       0 - Off
         #       1 - On (When dimmer is at max, shows 'On')
         #       2 - When dimmer is not at min or max.
         #       Unit 'LastLevel' is what controls the slider 
-        unitConfig = self.unitConfiguration(unitObj.Parent.DeviceID, unitObj.Unit)
-        if (unitConfig == None): 
-            Domoticz.Error("updateDimmer: Failed for "+unitObj.Name+", unable to find configuration.")
-            return
-
-        if ('value' in jsonDict):
-            maxBrightness = unitConfig["brightness_scale"] if ("brightness_scale" in unitConfig) else 99
+        unitObj = theRoute.unit
+        if (theEvent.hasValue):
+            maxBrightness = theRoute.brightnessScale
             oldnValue = unitObj.nValue
             oldsValue = unitObj.sValue
             oldlValue = unitObj.LastLevel
-            unitObj.nValue = 2 if (jsonDict['value'] > 0) else 0
-            if (jsonDict['value'] == maxBrightness):
+            unitObj.nValue = 2 if (theEvent.value > 0) else 0
+            if (theEvent.value == maxBrightness):
                 unitObj.nValue = 1
-            unitObj.sValue = str(jsonDict['value'])
-            if (jsonDict['value'] > 0):
-                unitObj.LastLevel = jsonDict['value']
+            unitObj.sValue = str(theEvent.value)
+            if (theEvent.value > 0):
+                unitObj.LastLevel = theEvent.value
 
-            self.performUpdate(unitObj, ((unitObj.nValue != oldnValue) or (unitObj.sValue != oldsValue) or (unitObj.LastLevel != oldlValue)), True)
-            Domoticz.Debug("updateDimmer: "+unitObj.Name+", Payload: "+str(jsonDict))
+            self.performUpdate(theRoute, ((unitObj.nValue != oldnValue) or (unitObj.sValue != oldsValue) or (unitObj.LastLevel != oldlValue)), True)
+            self.log.debug("updateDimmer: {}, Payload: {}", unitObj.Name, theEvent)
 
-    def updateBinarySwitch(self, unitObj, jsonDict):
+    def updateBinarySwitch(self, theRoute, theEvent):
         # nValue 0 - Off, 1 = On.  sValue can be updated but is ignored
-        # Read the configuration for the details
-        unitConfig = self.unitConfiguration(unitObj.Parent.DeviceID, unitObj.Unit)
-        if (unitConfig == None): 
-            Domoticz.Error("updateBinarySwitch: Failed for "+unitObj.Name+", unable to find configuration.")
-            return
-
-        if ('value' in jsonDict):
+        unitObj = theRoute.unit
+        if (theEvent.hasValue):
             oldValue = unitObj.nValue
-            unitObj.sValue = "On" if (jsonDict['value'] == unitConfig["payload_on"]) else "Off"
-            unitObj.nValue = 1 if (jsonDict['value'] == unitConfig["payload_on"]) else 0
-            self.performUpdate(unitObj, (unitObj.nValue != oldValue), True)
-            Domoticz.Debug("updateBinarySwitch: "+unitObj.Name+", Payload: "+str(jsonDict))
+            unitObj.sValue = "On" if (theEvent.value == theRoute.payloadOn) else "Off"
+            unitObj.nValue = 1 if (theEvent.value == theRoute.payloadOn) else 0
+            self.performUpdate(theRoute, (unitObj.nValue != oldValue), True)
+            self.log.debug("updateBinarySwitch: {}, Payload: {}", unitObj.Name, theEvent)
 
-    def updateScene(self, unitObj, jsonDict):
+    def updateScene(self, theRoute, theEvent):
         # Scenes are mapped to PushOn but this may be wrong because commands can't be triggered from Domoticz
         # Event flow looks like this for brief touch:
         #    2021-09-23 15:44:28.384: '{'time': 1632375583399, 'value': 0}'
@@ -340,7 +1081,7 @@ class BasePlugin:
         #    2021-09-23 15:48:05.399: '{'time': 1632376083330, 'value': 2}'
         #    2021-09-23 15:48:05.585: '{'time': 1632376083529, 'value': 1}'
         #    2021-09-23 15:48:06.581: '{'time': 1632376084530}'
-        
+        unitObj = theRoute.unit
         oldValue = unitObj.nValue
         
         #Default to 'Off'
@@ -348,271 +1089,988 @@ class BasePlugin:
         unitObj.nValue = 0
         
         # Look for 'On' events  (long touch is not supported yet)
-        if ('value' in jsonDict):
+        if (theEvent.hasValue):
             unitObj.sValue = "On"
             unitObj.nValue = 1
 
-        self.performUpdate(unitObj, (unitObj.nValue != oldValue), True)
-        Domoticz.Debug("updateScene: "+unitObj.Name+", Payload: "+str(jsonDict))
+        self.performUpdate(theRoute, (unitObj.nValue != oldValue), True)
+        self.log.debug("updateScene: {}, Payload: {}", unitObj.Name, theEvent)
         
-    def updateColor(self, unitObj, jsonDict):
+    def updateColor(self, theRoute, theEvent):
         # updateColor: Bedside Lamp_rgb_dimmer, Payload: {'time': 1632621863751, 'value': {'red': 62, 'green': 67, 'blue': 165}}
         # updateColor: Bedside Lamp_rgb_dimmer, Payload: {'time': 1632622088122, 'value': 75}
-        Domoticz.Log("updateColor: "+unitObj.Name+", Payload: "+str(jsonDict))
+        unitObj = theRoute.unit
 
-        if (not 'value' in jsonDict): return
+        if (not theEvent.hasValue): return
 
-        theValue = jsonDict['value']
+        theValue = theEvent.value
         if (isinstance(theValue, dict)):
             # Color update - {"b":165,"cw":0,"g":67,"m":3,"r":62,"t":0,"ww":0}
             oldValue = unitObj.Color
             unitObj.Color = json.dumps({"b":theValue["blue"],"cw":0,"g":theValue["green"],"m":0,"r":theValue["red"],"t":0,"ww":0})
-            self.performUpdate(unitObj, (unitObj.Color != oldValue), True)
-            Domoticz.Log("updateColor: "+unitObj.Name+", Payload: "+str(jsonDict))
+            self.performUpdate(theRoute, (unitObj.Color != oldValue), True)
+            self.log.debug("updateColor: {}, Payload: {}", unitObj.Name, theEvent)
         else:
             # Brightness update
             oldValue = unitObj.sValue
             unitObj.nValue = 1
             unitObj.sValue = str(theValue)
             unitObj.LastLevel = theValue
-            self.performUpdate(unitObj, (unitObj.LastLevel != oldValue), True)
-            Domoticz.Log("updateColor: "+unitObj.Name+", Payload: "+str(jsonDict))
+            self.performUpdate(theRoute, (unitObj.LastLevel != oldValue), True)
+            self.log.debug("updateColor: {}, Payload: {}", unitObj.Name, theEvent)
 
-    def updateBinarySensor(self, unitObj, jsonDict):
+    def updateBinarySensor(self, theRoute, theEvent):
         # zwave/7/113/0/Home_Security/Sensor_status: b'{"time":1632470645111,"value":2}'
         # zwave/7/48/0/Any: b'{"time":1632470726665,"value":false}'
-        Domoticz.Debug("updateBinarySensor: "+unitObj.Name+", Payload: "+str(jsonDict))
+        unitObj = theRoute.unit
+        self.log.debug("updateBinarySensor: {}, Payload: {}", unitObj.Name, theEvent)
 
-        # Read the configuration for the detaila
-        unitConfig = self.unitConfiguration(unitObj.Parent.DeviceID, unitObj.Unit)
-        if (unitConfig == None): 
-            Domoticz.Error("updateBinarySensor: Failed for "+unitObj.Name+", unable to find configuration.")
+        if (theEvent.hasValue):
+            oldValue = unitObj.nValue
+            unitObj.sValue = "On" if (theEvent.value == theRoute.payloadOn) else "Off"
+            unitObj.nValue = 1 if (theEvent.value == theRoute.payloadOn) else 0
+            self.performUpdate(theRoute, (unitObj.nValue != oldValue), True)
+            self.log.debug("updateBinarySensor: {}, Payload: {}", unitObj.Name, theEvent)
+
+    def updateNothing(self, theRoute, theEvent):
+        self.log.unitLog(id(theRoute.unit), "Unmapped message: {} '{}'", theRoute.unit.Name, theEvent)
+
+    def publishChange(self, topic, payload, deviceID=None):
+        # Tell everyone who has subscribed to it, or only the device's own gateway for a command
+        theSubscribers = self.subscriptions.match(topic)
+        theGateway = self.owningGateway(deviceID)
+        if (theGateway != None):
+            # A connection past its keep alive is dropped here rather than sent to
+            if (theGateway.connection != None): self.clientAlive(theGateway.connection)
+            if (theGateway.connection == None):
+                if (not self.holdForSession(theGateway, topic, payload)):
+                    theGateway.dropped += 1
+                    Domoticz.Error("Gateway '"+theGateway.clientID+"' for "+deviceID+" is not connected, not sent: "+topic)
+                return
+            theGateway.commands += 1
+            theSubscribers = {theGateway.connection:theSubscribers[theGateway.connection]} if (theGateway.connection in theSubscribers) else {}
+        else:
+            # Disconnected clients with a session get it when they reconnect
+            held = 0
+            for theGateway in self.gateways.values():
+                if (theGateway.connection == None) and (self.holdForSession(theGateway, topic, payload)):
+                    held += 1
+            if (len(theSubscribers) == 0) and (held > 0):
+                return
+        if (len(theSubscribers) == 0):
+            Domoticz.Error("No client has subscribed to: "+topic)
             return
+        for mqttConn in theSubscribers:
+            if (self.clientAlive(mqttConn)):
+                self.publishToClient(mqttConn, topic, payload, theSubscribers[mqttConn])
 
-        if ('value' in jsonDict):
-            oldValue = unitObj.nValue
-            unitObj.sValue = "On" if (jsonDict['value'] == unitConfig["payload_on"]) else "Off"
-            unitObj.nValue = 1 if (jsonDict['value'] == unitConfig["payload_on"]) else 0
-            self.performUpdate(unitObj, (unitObj.nValue != oldValue), True)
-            Domoticz.Debug("updateBinarySensor: "+unitObj.Name+", Payload: "+str(jsonDict))
-
-    def updateNothing(self, unitObj, jsonDict):
-        Domoticz.Log("updateNothing: "+unitObj.Name+", Payload: "+str(jsonDict))
-
-    def publishChange(self, topic, payload):
-        # Tell everyone!
-        for mqttConn in self.mqttClients:
-            if (self.mqttClients[mqttConn].Connected()):
-                messageDict = {"Verb":"PUBLISH", "QoS":1, "Topic":topic, "PacketIdentifier":1234, "Payload":payload}
-                Domoticz.Log("Publishing: "+str(messageDict)+", to "+mqttConn)
-                self.mqttClients[mqttConn].Send(messageDict)
+    def publishToClient(self, mqttConn, topic, payload, qos, retain=False):
+        if (not mqttConn in self.mqttClients) or (not self.mqttClients[mqttConn].Connected()):
+            Domoticz.Error("Client is not connected: "+mqttConn)
+            return
+        messageDict = {"Verb":"PUBLISH", "QoS":qos, "Topic":topic, "Payload":payload}
+        if (retain): messageDict["Retain"] = True
+        if (qos > 0):
+            # Packet identifier is allocated by the client's in flight window
+            theWindow = self.inFlight.setdefault(mqttConn, InFlightWindow())
+            messageDict = theWindow.submit(messageDict)
+            if (messageDict == None):
+                Domoticz.Log("Publishing queued, "+str(len(theWindow.inFlight))+" messages awaiting acknowledgement from "+mqttConn)
+                return
+        Domoticz.Log("Publishing: "+str(messageDict)+", to "+mqttConn)
+        self.mqttClients[mqttConn].Send(messageDict)
+
+    def holdForSession(self, theGateway, topic, payload):
+        # Keep a QoS 1 message for a disconnected client's session, False if it has no session subscribed at QoS 1
+        if (theGateway.cleanSession) or (not theGateway.sessionStored) or (theGateway.subscribedQoS(topic) != 1):
+            return False
+        theGateway.pending.append((topic, payload, 1))
+        theGateway.queued += 1
+        self.metrics.count("session.queued")
+        self.log.debug("Client '{}' is not connected, holding: {}", theGateway.clientID, topic)
+        self.trimSession(theGateway)
+        return True
+
+    def trimSession(self, theGateway):
+        while (len(theGateway.pending) > self.sessionQueueLimit):
+            topic, payload, qos = theGateway.pending.popleft()
+            theGateway.expired += 1
+            self.metrics.count("session.expired")
+            self.log.unitLog(theGateway.clientID, "Too many messages held for client '{}', oldest discarded: {}", theGateway.clientID, topic)
+
+    def resumeSession(self, mqttConn, clientID):
+        # Restore a session's subscriptions on the new connection and deliver what was held for it, in order
+        theGateway = self.gateways[clientID]
+        for topicFilter in theGateway.subscriptions:
+            self.subscriptions.subscribe(mqttConn, topicFilter, theGateway.subscriptions[topicFilter])
+        delivered = len(theGateway.pending)
+        while (len(theGateway.pending) > 0):
+            topic, payload, qos = theGateway.pending.popleft()
+            self.publishToClient(mqttConn, topic, payload, qos)
+        self.metrics.count("session.resumed")
+        self.metrics.count("session.delivered", delivered)
+        Domoticz.Log("Session resumed for '"+clientID+"', "+str(len(theGateway.subscriptions))+" subscriptions restored, "+str(delivered)+" held messages delivered")
+
+    def retainMessage(self, topic, payload, qos):
+        # A retained message with an empty payload clears the topic
+        if (len(payload) == 0):
+            self.retainedMessages.pop(topic, None)
+        else:
+            self.retainedMessages[topic] = [payload, min(qos, 1)]
+
+    def deliverRetained(self, mqttConn, topicFilter, grantedQoS):
+        for topic in self.retainedMessages:
+            if (SubscriptionTree.filterMatches(topicFilter, topic)):
+                payload, qos = self.retainedMessages[topic]
+                self.publishToClient(mqttConn, topic, payload, min(qos, grantedQoS), True)
+
+    def saveLastValues(self):
+        snapshot = {"version":1, "values":{}, "retained":{}}
+        for topic in self.lastValues:
+            payload, value, eventTime = self.lastValues[topic]
+            snapshot["values"][topic] = [Utf8(payload), value, eventTime]
+        for topic in self.retainedMessages:
+            payload, qos = self.retainedMessages[topic]
+            snapshot["retained"][topic] = [Utf8(payload), qos]
+        try:
+            with open(Parameters["HomeFolder"]+"Last Values.json", "w") as snapshotFile:
+                json.dump(snapshot, snapshotFile)
+            Domoticz.Debug("Saved "+str(len(snapshot["values"]))+" last values and "+str(len(snapshot["retained"]))+" retained messages.")
+        except (OSError, TypeError, ValueError) as err:
+            Domoticz.Error("Unable to save last values: "+str(err))
+
+    def loadLastValues(self):
+        # Reload the last value cache and apply any values that never made it into Domoticz before the stop
+        fileName = Parameters["HomeFolder"]+"Last Values.json"
+        if (not os.path.exists(fileName)):
+            return
+        try:
+            with open(fileName, "r") as snapshotFile:
+                snapshot = json.load(snapshotFile)
+        except (OSError, ValueError) as err:
+            Domoticz.Error("Unable to load last values: "+str(err))
+            return
+        if (not isinstance(snapshot, dict)):
+            Domoticz.Error("Last values snapshot is damaged and was ignored: not a JSON object")
+            return
+        if (snapshot.get("version") != 1):
+            Domoticz.Error("Last values snapshot version "+str(snapshot.get("version"))+" not supported, ignored.")
+            return
+        # Unpacked in full before anything is applied, a damaged snapshot is ignored as a whole
+        try:
+            retainedMessages = {}
+            for topic in snapshot["retained"]:
+                payload, qos = snapshot["retained"][topic]
+                retainedMessages[topic] = [payload.encode(), int(qos)]
+            lastValues = {}
+            for topic in snapshot["values"]:
+                payload, value, eventTime = snapshot["values"][topic]
+                lastValues[topic] = [payload.encode(), value, int(eventTime) if (eventTime != None) else None]
+        except (KeyError, ValueError, TypeError, AttributeError) as err:
+            Domoticz.Error("Last values snapshot is damaged and was ignored: "+repr(err))
+            return
+        self.retainedMessages.update(retainedMessages)
+        applied = 0
+        for topic in lastValues:
+            self.lastValues[topic] = lastValues[topic]
+            eventTime = lastValues[topic][2]
+            theRoute = self.topicRoutes.get(topic)
+            if (theRoute == None) or (theRoute.unit == None) or (eventTime == None):
+                continue
+            if (eventTime >= LastUpdateToMillis(theRoute.unit.LastUpdate)+1000):
+                self.synchroniseData(topic, self.lastValues[topic][0])
+                applied += 1
             else:
-                Domoticz.Error("Client is not connected: "+mqttConn)
+                theRoute.lastTime = eventTime
+        Domoticz.Log("Loaded "+str(len(self.lastValues))+" last values, "+str(applied)+" newer than Domoticz applied.")
+
+    def publishCoalesced(self, topic, payload, deviceID=None):
+        now = time.monotonic()
+        if (topic in self.pendingCommands):
+            self.pendingCommands[topic][0] = payload
+            self.log.debug("Command for {} replaced by: {}", topic, payload)
+        elif (now - self.lastCommandSent.get(topic, 0.0) >= self.commandWindow):
+            self.lastCommandSent[topic] = now
+            self.publishChange(topic, payload, deviceID)
+        else:
+            self.pendingCommands[topic] = [payload, self.lastCommandSent[topic] + self.commandWindow, deviceID]
+            self.setHeartbeat()
+
+    def flushCommands(self, force=False):
+        if (len(self.pendingCommands) == 0):
+            return
+        now = time.monotonic()
+        for topic in [t for t in self.pendingCommands if (force) or (self.pendingCommands[t][1] <= now)]:
+            payload, due, deviceID = self.pendingCommands.pop(topic)
+            self.lastCommandSent[topic] = now
+            self.publishChange(topic, payload, deviceID)
+        if (len(self.pendingCommands) == 0):
+            self.setHeartbeat()
+
+    def setHeartbeat(self):
+        # Held commands (and pipeline mode) need the fast heartbeat so nothing waits for the normal one
+        theInterval = self.fastHeartbeat if (len(self.pendingCommands) > 0) or (self.pipelineWorker != None) else self.normalHeartbeat
+        if (theInterval != self.heartbeatInterval):
+            self.heartbeatInterval = theInterval
+            Domoticz.Heartbeat(theInterval)
+            self.log.debug("Heartbeat interval set to {} seconds", theInterval)
+
+    def acknowledgePublish(self, mqttConn, identifier):
+        if (not mqttConn in self.inFlight):
+            return
+        for messageDict in self.inFlight[mqttConn].acknowledge(identifier):
+            self.log.debug("Publishing queued message: {}, to {}", messageDict, mqttConn)
+            self.mqttClients[mqttConn].Send(messageDict)
+
+    def retransmitPublishes(self):
+        for mqttConn in self.inFlight:
+            resend, failed = self.inFlight[mqttConn].expired()
+            for messageDict in failed:
+                Domoticz.Error("No acknowledgement from "+mqttConn+", giving up on: "+messageDict["Topic"]+" '"+str(messageDict["Payload"])+"'")
+            for messageDict in resend:
+                Domoticz.Log("Publishing again: "+str(messageDict)+", to "+mqttConn)
+                self.mqttClients[mqttConn].Send(messageDict)
+
+    def clientAlive(self, mqttConn):
+        # False if the client has outlived its keep alive, it is disconnected and forgotten first
+        theActivity = self.clientActivity.get(mqttConn)
+        if (theActivity == None):
+            return True
+        lastActivity, keepAlive = theActivity
+        limit = self.connectTimeout if (keepAlive == None) else keepAlive * self.keepAliveGrace
+        silent = time.monotonic() - lastActivity
+        if (limit == 0) or (silent <= limit):
+            return True
+        clientID = self.clientIDs.get(mqttConn)
+        Domoticz.Log("Client "+("'"+clientID+"' " if (clientID != None) else "")+"at "+mqttConn+" silent for "+str(int(silent))+" seconds"+
+                     (" (keep alive "+str(keepAlive)+")" if (keepAlive != None) else " without connecting")+", disconnected")
+        self.metrics.count("clients.reaped")
+        if (clientID in self.gateways): self.gateways[clientID].reaped += 1
+        theConn = self.mqttClients.get(mqttConn)
+        self.forgetClient(mqttConn)
+        if (theConn != None): theConn.Disconnect()
+        return False
+
+    def reapClients(self):
+        for mqttConn in list(self.clientActivity):
+            self.clientAlive(mqttConn)
+
+    def forgetClient(self, mqttConn):
+        self.mqttClients.pop(mqttConn, None)
+        self.clientActivity.pop(mqttConn, None)
+        self.subscriptions.removeClient(mqttConn)
+        theWindow = self.inFlight.pop(mqttConn, None)
+        clientID = self.clientIDs.pop(mqttConn, None)
+        if (clientID in self.gateways) and (self.gateways[clientID].connection == mqttConn):
+            theGateway = self.gateways[clientID]
+            theGateway.connection = None
+            if (clientID in self.anonymousClients):
+                self.anonymousClients.discard(clientID)
+                del self.gateways[clientID]
+            elif (theGateway.cleanSession):
+                theGateway.clearSession()
+            elif (theWindow != None):
+                # Messages not acknowledged yet go first when the session resumes
+                unacknowledged = [entry[0] for entry in theWindow.inFlight.values()] + list(theWindow.queued)
+                theGateway.pending.extendleft([(messageDict["Topic"], messageDict["Payload"], messageDict["QoS"]) for messageDict in reversed(unacknowledged)])
+                self.trimSession(theGateway)
+
+    def connectGateway(self, mqttConn, clientID, cleanSession=True):
+        # A client ID can only be connected once, a new connection takes over from the old one. Returns True if
+        # the client's session from an earlier connection is being resumed (CONNACK SessionPresent)
+        theGateway = self.gateways.get(clientID)
+        if (theGateway == None):
+            theGateway = self.gateways[clientID] = GatewayClient(clientID)
+        if (theGateway.connection != None) and (theGateway.connection != mqttConn):
+            Domoticz.Log("Gateway '"+clientID+"' reconnected from "+mqttConn+", dropping "+theGateway.connection)
+            oldConn = self.mqttClients.get(theGateway.connection)
+            self.forgetClient(theGateway.connection)
+            if (oldConn != None): oldConn.Disconnect()
+        theGateway.connection = mqttConn
+        theGateway.connections += 1
+        self.clientIDs[mqttConn] = clientID
+
+        sessionPresent = (not cleanSession) and (theGateway.sessionStored)
+        if (cleanSession) and (len(theGateway.pending) > 0):
+            Domoticz.Log("Client '"+clientID+"' started a clean session, "+str(len(theGateway.pending))+" held messages discarded")
+        if (not sessionPresent):
+            theGateway.clearSession()
+        theGateway.cleanSession = cleanSession
+        theGateway.sessionStored = (not cleanSession)
+        return sessionPresent
+
+    def tagDevice(self, deviceID, clientID):
+        # Remember which gateway a device belongs to
+        theDevice = self.deviceMappings.get(deviceID)
+        if (clientID == None) or (clientID in self.anonymousClients) or (theDevice == None) or (theDevice.clientID == clientID):
+            return
+        if (theDevice.clientID != None):
+            Domoticz.Log(deviceID+" moved from gateway '"+theDevice.clientID+"' to '"+clientID+"'")
+        theDevice.clientID = clientID
+        homeID = HomeID(deviceID)
+        if (homeID != None): self.gateways[clientID].homeIDs.add(homeID)
+        self.markConfigDirty()
+
+    def owningGateway(self, deviceID):
+        # Gateway a command for the device should go to, None to send it to every subscriber
+        theDevice = self.deviceMappings.get(deviceID) if (deviceID != None) else None
+        if (theDevice == None):
+            return None
+        if (theDevice.clientID != None):
+            return self.gateways.get(theDevice.clientID)
+        # Not tagged yet (configuration from an older version), a gateway serving its Z-Wave network will do
+        homeID = HomeID(deviceID)
+        for theGateway in self.gateways.values():
+            if (homeID in theGateway.homeIDs):
+                return theGateway
+        return None
 
     def unitConfiguration(self, deviceID, unitNum):
         # Sanity check data
-        if (not deviceID in self.pluginConfig["devices"]):
+        if (not deviceID in self.deviceMappings):
             Domoticz.Error(deviceID+" not found in plugin configuration.")
             return None
-        if (not str(unitNum) in self.pluginConfig["devices"][deviceID]["units"]):
+        if (not int(unitNum) in self.deviceMappings[deviceID].units):
             Domoticz.Error(str(unitNum)+" not found in "+deviceID+" plugin configuration.")
             return None
-        return self.pluginConfig["devices"][deviceID]["units"][str(unitNum)]
+        return self.deviceMappings[deviceID].units[int(unitNum)]
 
     def typeFromConfiguration(self, deviceID, unitNum):
         unitConfig = self.unitConfiguration(deviceID, unitNum)
-        if (unitConfig == None) or (not "mapped_type" in unitConfig):
-            Domoticz.Error(deviceID+"\\"+str(unitNum)+" not mapped in plugin configuration.")
+        if (unitConfig == None): return None
+        return unitConfig.mappedType
+
+    def routeTopic(self, Topic):
+        # Resolve a state topic to its unit and updater once, subsequent messages use the cached route
+        oldRoute = self.topicRoutes.pop(Topic, None)
+        if (oldRoute != None):
+            self.aggregatedRoutes.discard(oldRoute)
+            self.pendingMeters.discard(oldRoute)
+        if (not Topic in self.topicMappings):
+            if (not Topic[Topic.rfind('/')+1:] in self.completelyIgnore):
+                Domoticz.Log(Topic+" not found in Topics configuration.")
+            else:
+                self.log.debug("{} not found in Topics configuration.", Topic)
             return None
-        return unitConfig["mapped_type"]
 
-    def synchroniseData(self, Topic, Payload):
+        # Short cut to the actual device details
+        theMapping = self.topicMappings[Topic]
+        deviceID = theMapping.deviceID
+        theType = theMapping.mappedType
+        if (not deviceID in Devices):
+            Domoticz.Error(deviceID+" not found in plugin Devices dictionary.")
+            return None
+
+        # if a unit is available then this is a normal topic
+        if (theMapping.unitNum > 0):
+            unitNum = theMapping.unitNum
+            if (not unitNum in Devices[deviceID].Units):
+                Domoticz.Error(str(unitNum)+" not found in "+deviceID+" plugin Units dictionary.")
+                return None
+            theUnit = Devices[deviceID].Units[unitNum]
+            theUpdate = self.typeMapping[theType]["update"] if (theType in self.typeMapping) else self.updateNothing
+            theAggregate = self.typeMapping[theType]["aggregate"] if (theType in self.typeMapping) and ("aggregate" in self.typeMapping[theType]) else None
+            theHistory = None
+            if (theUpdate in self.historyUpdates):
+                # A route rebuilt by discovery keeps its readings
+                theHistory = oldRoute.history if (oldRoute != None) and (oldRoute.history != None) else ReadingHistory(self.historySize)
+            else:
+                theAggregate = None
+            theRoute = TopicRoute(deviceID, unitNum, theUnit, theType, theUpdate, theMapping, self.coalesceSettings(theType, theMapping) if (theAggregate == None) else None,
+                                  self.touchSettings(theType), theHistory, theAggregate)
+            if (oldRoute != None) and (oldRoute.deviceID == deviceID) and (oldRoute.unitNum == unitNum):
+                # Carry the meter coalescing state across the rebuild, a held reading stays held (or is written if the unit no longer coalesces)
+                theRoute.writtenValue = oldRoute.writtenValue
+                theRoute.lastWrite = oldRoute.lastWrite
+                if (oldRoute.pendingSvalue != None):
+                    if (theRoute.coalesce != None):
+                        theRoute.pendingValue = oldRoute.pendingValue
+                        theRoute.pendingSvalue = oldRoute.pendingSvalue
+                        self.pendingMeters.add(theRoute)
+                    else:
+                        self.writeMeter(theRoute, oldRoute.pendingValue, oldRoute.pendingSvalue, time.monotonic())
+        else:
+            # Device level topic (such as battery)
+            if (not theType in self.specialHandling):
+                Domoticz.Log("Unmapped device level topic: "+Topic+" ("+theType+")")
+                return None
+            theRoute = TopicRoute(deviceID, None, None, theType, self.specialHandling[theType]["update"])
+
+        self.topicRoutes[Topic] = theRoute
+        return theRoute
+
+    def coalesceSettings(self, theType, unitConfig):
+        # Type defaults with any unit level overrides applied, None if the unit is not coalesced
+        settings = dict(self.typeMapping[theType]["coalesce"]) if (theType in self.typeMapping) and ("coalesce" in self.typeMapping[theType]) else None
+        if (unitConfig != None) and (unitConfig.coalesce != None):
+            if (unitConfig.coalesce == False):
+                return None
+            settings = settings if (settings != None) else {"absolute":0.0, "relative":0.0, "interval":0, "hold":0}
+            settings.update(unitConfig.coalesce)
+        return settings
+
+    def touchSettings(self, theType):
+        # Type override or the default, never longer than the limit so 'last seen' and sensor timeouts keep working
+        theInterval = self.typeMapping[theType]["touchInterval"] if (theType in self.typeMapping) and ("touchInterval" in self.typeMapping[theType]) else self.touchInterval
+        return min(theInterval, self.touchIntervalLimit)
+
+    def buildRoutes(self):
+        self.topicRoutes = {}
+        for topic in self.topicMappings:
+            self.routeTopic(topic)
+        Domoticz.Debug("Routing table built, "+str(len(self.topicRoutes))+" of "+str(len(self.topicMappings))+" topics routed.")
+
+    def synchroniseData(self, Topic, Payload, theRoute=None, theEvent=None, unchangedSince=None):
+        # theRoute, theEvent and unchangedSince are passed in when the pipeline worker has already looked them up
         try:
             # No devices yet so just exit
-            if (not "devices" in self.pluginConfig):
+            if (len(self.deviceMappings) == 0):
                 return
 
-            jsonDict = json.loads(Payload)
-
-            if (not Topic in self.pluginConfig["topics"]):
-                topicList = Topic.split('/')
-                if (self.completelyIgnore.find(topicList[len(topicList)-1]) == -1):
-                    Domoticz.Log(Topic+" not found in Topics configuration.")
-                else:
-                    Domoticz.Debug(Topic+" not found in Topics configuration.")
+            # Unit deleted by the user
+            if (Topic in self.removedTopics):
+                self.metrics.count("removed_topics")
                 return
 
-            # Short cut to the actual device details
-            theTopic = self.pluginConfig["topics"][Topic]
-            deviceID = theTopic["deviceID"]
-            if (not deviceID in Devices):
-                Domoticz.Error(deviceID+" not found in plugin Devices dictionary.")
+            # Already known to have nowhere to go
+            if (Topic in self.unmappedTopics):
+                self.unmappedTopics[Topic] += 1
+                self.metrics.count("unknown_topics")
                 return
 
-            # if a unit is available then this is a normal topic
-            if ("unit" in theTopic):
-                unitNum = theTopic["unit"]
+            if (theRoute == None) or (theRoute != self.topicRoutes.get(Topic)):
+                theRoute = self.topicRoutes.get(Topic)
+                if (theRoute == None):
+                    theRoute = self.routeTopic(Topic)
+                    if (theRoute == None):
+                        self.unmappedTopics[Topic] = 1
+                        self.metrics.count("unknown_topics")
+                        return
+            self.metrics.count("type."+theRoute.mappedType)
 
-                # Get type from config
-                theType = self.typeFromConfiguration(deviceID, unitNum)
-                if (theType == None): return
+            if (theEvent == None):
+                theEvent = DecodeTimeValue(Payload)
 
-                # Ignore events in the past
-                if ("time" in jsonDict):
-                    eventDT = datetime.fromtimestamp(int(jsonDict["time"])/1000).strftime("%Y-%m-%d %H:%M:%S")
-                    if (not int(unitNum) in Devices[deviceID].Units):
-                        Domoticz.Error(unitNum+" not found in "+deviceID+" plugin Units dictionary.")
-                        return
-                    theUnit = Devices[deviceID].Units[int(unitNum)]
-                    if (eventDT >= str(theUnit.LastUpdate)):
-                        # Find updater
-                        Domoticz.Debug(theUnit.Name+" ("+str(theUnit.nValue)+","+theUnit.sValue+") with payload: '"+str(jsonDict)+"'")
-                        if (theType in self.typeMapping):
-                            self.typeMapping[theType]["update"](theUnit, jsonDict)
-                        else:
-                            Domoticz.Log("Unmapped message: "+theUnit.Name+" '"+str(jsonDict)+"'")
-                    else:
-                        Domoticz.Debug("Discarding out of date event. Event: "+eventDT+", Unit:"+str(theUnit.LastUpdate))
-            else:
+            if (theRoute.unit == None):
                 # Device level topic (such as battery)
-                theType = theTopic["mapped_type"]
-                Domoticz.Debug("Device level topic: "+theType)
-                if (not theType in self.specialHandling):
-                    Domoticz.Log("Unmapped message: "+theType+" '"+str(jsonDict)+"'")
-                    return
-                for unit in Devices[deviceID].Units:
-                    self.specialHandling[theType]["update"](Devices[deviceID].Units[unit], jsonDict)
+                self.log.debug("Device level topic: {}", theRoute.mappedType)
+                self.lastValues[Topic] = [Payload, theEvent.value, theEvent.time]
+                theRoute.update(theRoute, theEvent)
+            elif (theEvent.time != None):
+                # Ignore events in the past, LastUpdate is only consulted the first time a unit is seen
+                theUnit = theRoute.unit
+                eventTime = theEvent.time
+                if (theRoute.lastTime == None):
+                    theRoute.lastTime = LastUpdateToMillis(theUnit.LastUpdate)
+                if (eventTime >= theRoute.lastTime):
+                    # The pipeline worker found the value the same as the event last applied, only a Touch() can be due
+                    unchanged = (unchangedSince != None) and (unchangedSince == theRoute.lastTime)
+                    theRoute.lastTime = eventTime
+                    self.lastValues[Topic] = [Payload, theEvent.value, eventTime]
+                    self.log.debug("{} ({},{}) with payload: '{}'", theUnit.Name, theUnit.nValue, theUnit.sValue, theEvent)
+                    if (theRoute.history == None) or (not self.recordReading(theRoute, theEvent)):
+                        if (unchanged):
+                            self.metrics.count("pipeline.unchanged")
+                            self.performUpdate(theRoute, False)
+                        else:
+                            theRoute.update(theRoute, theEvent)
+                else:
+                    self.metrics.count("stale_events")
+                    self.log.debug("Discarding out of date event. Event: {}, Last: {}", eventTime, theRoute.lastTime)
 
+        except json.JSONDecodeError:
+            self.metrics.count("json_errors")
+            self.log.unitLog(Topic, "Invalid JSON payload ignored for: {}", Topic)
         except:
             exc_type, exc_obj, tb = sys.exc_info()
             Domoticz.Error("Unexpected error: " + str(sys.exc_info()[0])+" at line: "+str(tb.tb_lineno))
             Domoticz.Dump()
 
-    def synchroniseDevice(self, Topic, Payload):
+    def addMapping(self, theMapping):
+        # Add (or refresh) a mapping in the device table and index its state topics
+        theDevice = self.deviceMappings.get(theMapping.deviceID)
+        if (theDevice == None):
+            theDevice = self.deviceMappings[theMapping.deviceID] = DeviceMapping(theMapping.deviceID)
+        if (theMapping.unitNum > 0):
+            theDevice.units[theMapping.unitNum] = theMapping
+        else:
+            theDevice.deviceLevel[theMapping.mappedType] = theMapping
+        for topic in theMapping.stateTopics():
+            self.topicMappings[topic] = theMapping
+
+        # Topics of the device that could not be routed before (no unit created yet) may route now
+        if (len(self.unmappedTopics) > 0):
+            for topic in [topic for mapping in theDevice.mappings() for topic in mapping.stateTopics()]:
+                self.unmappedTopics.pop(topic, None)
+
+    def removeMapping(self, theMapping):
+        # Forget a mapping and everything derived from it, its state topics are tombstoned
+        theDevice = self.deviceMappings[theMapping.deviceID]
+        if (theMapping.unitNum > 0):
+            theDevice.units.pop(theMapping.unitNum, None)
+        else:
+            theDevice.deviceLevel.pop(theMapping.mappedType, None)
+        for topic in theMapping.stateTopics():
+            self.topicMappings.pop(topic, None)
+            self.lastValues.pop(topic, None)
+            theRoute = self.topicRoutes.pop(topic, None)
+            if (theRoute != None):
+                self.pendingMeters.discard(theRoute)
+                self.aggregatedRoutes.discard(theRoute)
+            self.removedTopics.add(topic)
+
+    def removeUnit(self, deviceID, unitNum):
+        # A unit has gone from Domoticz, when it was the device's last one the device level mappings go too
+        theDevice = self.deviceMappings.get(deviceID)
+        if (theDevice == None) or (not unitNum in theDevice.units):
+            return False
+        self.removeMapping(theDevice.units[unitNum])
+        if (len(theDevice.units) == 0):
+            for theMapping in list(theDevice.deviceLevel.values()):
+                self.removeMapping(theMapping)
+            del self.deviceMappings[deviceID]
+            self.batteryLevels.pop(deviceID, None)
+        self.markConfigDirty()
+        return True
+
+    def reconcileDevices(self):
+        # Single sweep at start for units deleted while the plugin was not running
+        removed = 0
+        for deviceID in list(self.deviceMappings):
+            theUnits = Devices[deviceID].Units if (deviceID in Devices) else {}
+            for unitNum in [unit for unit in self.deviceMappings[deviceID].units if (not unit in theUnits)]:
+                self.removeUnit(deviceID, unitNum)
+                removed += 1
+        unmapped = 0
+        for deviceID in Devices:
+            if (deviceID != self.metricsDeviceID):
+                theDevice = self.deviceMappings.get(deviceID)
+                unmapped += len([unit for unit in Devices[deviceID].Units if (theDevice == None) or (not unit in theDevice.units)])
+        if (removed > 0):
+            Domoticz.Log(str(removed)+" units deleted from Domoticz while stopped, removed from the configuration.")
+        if (unmapped > 0):
+            Domoticz.Log(str(unmapped)+" Domoticz units have no configuration, they will not be updated until rediscovered.")
+
+    def storeDiscoveryDetails(self, theMapping, jsonDict):
+        # Copy the interesting parts of a discovery payload into the mapping, True if it changed
+        changed = theMapping.update(jsonDict)
+        self.addMapping(theMapping)
+        return changed
+
+    def configurationToSave(self):
+        # Topics are stored relative to the longest path shared by all of a device's topics
+        theDevices = {}
+        for deviceID in self.deviceMappings:
+            theMappings = self.deviceMappings[deviceID].mappings()
+            prefix = os.path.commonprefix([topic for theMapping in theMappings for topic in theMapping.topics.values()])
+            prefix = prefix[:prefix.rfind("/")+1]
+            theDevices[deviceID] = {"prefix":prefix, "units":[theMapping.toConfiguration(prefix) for theMapping in theMappings]}
+            if (self.deviceMappings[deviceID].clientID != None): theDevices[deviceID]["client"] = self.deviceMappings[deviceID].clientID
+        return {"version":self.configVersion, "devices":theDevices}
+
+    def loadConfiguration(self, config):
+        self.deviceMappings = {}
+        self.topicMappings = {}
+        self.removedTopics = set()
+        if (not "version" in config):
+            self.migrateConfiguration(config)
+            return
+        if (config["version"] != self.configVersion):
+            Domoticz.Error("Configuration version "+str(config["version"])+" is not supported, devices will be mapped again as they are discovered.")
+            return
+        for deviceID in config["devices"]:
+            theDevice = config["devices"][deviceID]
+            deviceID = sys.intern(deviceID)
+            for entry in theDevice["units"]:
+                self.addMapping(UnitMapping.fromConfiguration(deviceID, entry, theDevice["prefix"]))
+            if ("client" in theDevice) and (deviceID in self.deviceMappings):
+                clientID = theDevice["client"]
+                self.deviceMappings[deviceID].clientID = clientID
+                theGateway = self.gateways.setdefault(clientID, GatewayClient(clientID))
+                if (HomeID(deviceID) != None): theGateway.homeIDs.add(HomeID(deviceID))
+        Domoticz.Debug("Configuration loaded, "+str(len(self.deviceMappings))+" devices, "+str(len(self.topicMappings))+" state topics.")
+
+    def migrateConfiguration(self, config):
+        # Version 1: {"devices": {deviceID: {"units": {"1": {...}}, "battery_level": {...}}}, "topics": {...}}, the topic index is rebuilt
+        if (not "devices" in config):
+            return
+        for deviceID in config["devices"]:
+            theDevice = config["devices"][deviceID]
+            deviceID = sys.intern(deviceID)
+            entries = [(int(unitNum), theDevice["units"][unitNum]) for unitNum in theDevice.get("units", {})]
+            entries += [(0, theDevice[key]) for key in theDevice if (key != "units")]
+            for unitNum, valueDict in entries:
+                if (not "mapped_type" in valueDict):
+                    Domoticz.Debug("Unmapped entry "+deviceID+"\\"+str(unitNum)+" dropped from configuration.")
+                    continue
+                theMapping = UnitMapping(deviceID, unitNum, sys.intern(valueDict["mapped_type"]), sys.intern(valueDict.get("reported_type", "")))
+                theMapping.update(valueDict)
+                if ("coalesce" in valueDict): theMapping.coalesce = valueDict["coalesce"] if (valueDict["coalesce"] != None) else False
+                self.addMapping(theMapping)
+        Domoticz.Log("Configuration migrated to version "+str(self.configVersion)+", "+str(len(self.deviceMappings))+" devices, "+str(len(self.topicMappings))+" state topics.")
+        self.markConfigDirty()
+
+    def synchroniseDevice(self, Topic, Payload, clientID=None):
+        # Discovery messages are collected and handled together once the gateway goes quiet, see flushDiscovery
         try:
-            jsonDict = json.loads(Payload)
-            mqttDict = jsonDict["device"]
-            deviceID = mqttDict["identifiers"][0]
-
-            #Domoticz.Log("Topic: "+str(jsonDict["state_topic"] ))
-            if (not "devices" in self.pluginConfig):
-                self.pluginConfig["devices"] = {}
-                self.pluginConfig["topics"] = {}
-
-            # if the device is already known then exit
-            if (not deviceID in self.pluginConfig["devices"]):
-                self.pluginConfig["devices"][deviceID] = {"units":{}}
-            unitsDict = self.pluginConfig["devices"][deviceID]["units"]
-
-            # Cycle through any existing units to see if the topic is already handled
-            for unit in unitsDict:
-                if ("state_topic" in unitsDict[unit]) and (unitsDict[unit]["state_topic"] == jsonDict["state_topic"]):
-                    Domoticz.Debug(jsonDict["state_topic"]+" is already mapped against "+deviceID+"\\"+unit)
-                    return
-
-            # Topic not handled so might need to create if we should handle it
-			# Device type is in the topic name
-            # domoticz/sensor/Bedside_Lamp/electric_kwh_value/config
-            topicList = Topic.split('/')
-            if (len(topicList) != 5):
-                Domoticz.Error("Incorrect topic structure, device not created: "+Topic)
+            # An identical repeat of a discovery message already handled needs no work at all
+            fingerprint = hashlib.blake2b(Payload if (isinstance(Payload, (bytes, bytearray))) else Payload.encode("utf-8"), digest_size=16).digest()
+            if (self.discoveryFingerprints.get(Topic) == fingerprint):
+                self.log.debug("{} unchanged since last discovery, ignored", Topic)
                 return
-            typeName = self.typeMapping[topicList[3]]["type"] if topicList[3] in self.typeMapping else None
-
-            # This is new so consider:
-            #   1.  Should this be a new Unit?
-            #   2.  Is this of Device level interest?
-            #   3.  Otherwise ignore it
-            if (typeName == None) and (not topicList[3] in self.specialHandling):
-                Domoticz.Debug(jsonDict["state_topic"]+" ignored")
-                return
-
-            valueDict=None
-            #   1.  Should this be a new Unit?
-            unitNum = "0"
-            if (typeName != None):
-                # Unit number doesn't matter so determine the next available
-                for unit in unitsDict:
-                    if (unit > unitNum):
-                        unitNum = unit
-                unitNum = str(int(unitNum)+1)
-                unitsDict[unitNum] = {}
-                valueDict = unitsDict[unitNum]
-
-            #   2.  Is this of Device level interest?
-            if (topicList[3] in self.specialHandling):
-                self.pluginConfig["devices"][deviceID][topicList[3]] = {}
-                valueDict = self.pluginConfig["devices"][deviceID][topicList[3]]
-
-            # Add known details
-            valueDict["mapped_type"] = topicList[3]
-            valueDict["reported_type"] = topicList[1]
-
-            # Retain all state and command topics for later use
-            for entry in jsonDict:
-                if (entry.find("_topic") != -1):
-                    valueDict[entry] = jsonDict[entry]
-                    if (entry.find("state_topic") != -1):
-                        # Store state topics in the secondary structure for quick lookup 
-                        if (unitNum == "0"):
-                            self.pluginConfig["topics"][jsonDict[entry]] = { "deviceID":deviceID, "mapped_type":topicList[3] }
-                        else:
-                            self.pluginConfig["topics"][jsonDict[entry]] = { "deviceID":deviceID, "unit":unitNum }
-
-            # Look for specific attributes that may be useful later
-            if ("payload_on" in jsonDict): valueDict["payload_on"] = jsonDict["payload_on"]
-            if ("payload_off" in jsonDict): valueDict["payload_off"] = jsonDict["payload_off"]
-            if ("on_command_type" in jsonDict): valueDict["on_command_type"] = jsonDict["on_command_type"]
-            if ("brightness_scale" in jsonDict): valueDict["brightness_scale"] = jsonDict["brightness_scale"]
-
-            # Update the persistent configuration
-            Domoticz.Configuration(self.pluginConfig)
 
-            # Create the matching Domoticz DeviceStatus entries if it has been mapped to a type
-            if (typeName == None):
-                Domoticz.Debug("'"+topicList[3]+"' is not a mapped type, device not created: "+Topic)
+            jsonDict = json.loads(Payload)
+            if (not isinstance(jsonDict, dict)):
+                self.metrics.count("json_errors")
+                self.log.unitLog(Topic, "Discovery payload is not a JSON object, ignored for: {}", Topic)
                 return
+            if (len(self.discoveryBatch) == 0):
+                self.discoveryStarted = time.monotonic()
+            self.discoveryLast = time.monotonic()
+            self.discoveryBatch[Topic] = (jsonDict, fingerprint, clientID)
+            if ("state_topic" in jsonDict) and (not jsonDict["state_topic"] in self.topicRoutes):
+                self.discoveryPending.add(jsonDict["state_topic"])
+            if (len(self.discoveryBatch) >= self.discoveryBatchLimit):
+                self.flushDiscovery(True)
+        except json.JSONDecodeError:
+            self.metrics.count("json_errors")
+            self.log.unitLog(Topic, "Invalid JSON payload ignored for: {}", Topic)
+        except:
+            exc_type, exc_obj, tb = sys.exc_info()
+            Domoticz.Error("Unexpected error: " + str(sys.exc_info()[0])+" at line: "+str(tb.tb_lineno))
+            Domoticz.Dump()
 
-            name = jsonDict["name"]
-            # If there is Domoticz type name then use that in the name rather than the supplied one
-            if (name.find(valueDict["mapped_type"]) > -1): 
-                if (topicList[3] in self.typeMapping) and ("suffix" in self.typeMapping[topicList[3]]):
-                    suffix = self.typeMapping[topicList[3]]["suffix"]
-                    name = name.replace("_"+topicList[3], " "+suffix)
-                    if (not isinstance(typeName, tuple)): 
-                        name = name.replace(typeName+" "+typeName, typeName)
-                elif (not isinstance(typeName, tuple)): 
-                    name = name.replace("_"+topicList[3], " "+typeName)
+    def flushDiscovery(self, force=False):
+        # Handle the collected discovery messages after 'discoveryQuiet' seconds without one (or 'discoveryMaxWait' seconds
+        # after the first) or straight away when forced
+        if (len(self.discoveryBatch) == 0):
+            return
+        now = time.monotonic()
+        if (not force) and (now - self.discoveryLast < self.discoveryQuiet) and (now - self.discoveryStarted < self.discoveryMaxWait):
+            return
+        theBatch = self.discoveryBatch
+        theHeld = self.discoveryHeld
+        self.discoveryBatch = {}
+        self.discoveryPending = set()
+        self.discoveryHeld = []
+        started = time.perf_counter()
+        outcomes = self.processDiscovery(theBatch)
+        elapsed = time.perf_counter() - started
+        self.metrics.timing("discoveryBatch", elapsed)
+        self.metrics.count("discovery.batches")
+        Domoticz.Log("Discovery: "+str(len(theBatch))+" messages for "+str(outcomes["devices"])+" devices, "+str(outcomes["created"])+" units created, "+
+                     str(outcomes["updated"])+" updated, "+str(outcomes["unchanged"])+" unchanged, "+str(outcomes["ignored"])+" ignored, "+
+                     str(outcomes["failed"])+" failed in "+str(round(elapsed*1000))+" ms"+
+                     (", "+str(len(theHeld))+" held state messages applied" if (len(theHeld) > 0) else ""))
+        for Topic, Payload in theHeld:
+            self.handleData(Topic, Payload)
+
+    def holdData(self, Topic, Payload):
+        # A state message for a topic whose discovery is still waiting, applied after the batch
+        self.discoveryHeld.append((Topic, Payload))
+        self.metrics.count("discovery.held")
+        if (len(self.discoveryHeld) >= self.discoveryHeldLimit):
+            self.flushDiscovery(True)
+
+    def handleData(self, Topic, Payload):
+        if (self.pipelineWorker != None):
+            self.queueData(Topic, Payload)
+        else:
+            started = time.perf_counter()
+            self.synchroniseData(Topic, Payload)
+            self.metrics.timing("synchroniseData", time.perf_counter()-started)
+
+    def processDiscovery(self, theBatch):
+        # Group the messages by device so each device's unit numbers are allocated and its units created in one go. The
+        # configuration is saved by the heartbeat's write-behind
+        outcomes = collections.Counter()
+        theDevices = {}
+        for Topic in theBatch:
+            try:
+                deviceID = sys.intern(theBatch[Topic][0]["device"]["identifiers"][0])
+                theDevices.setdefault(deviceID, []).append(Topic)
+            except (KeyError, IndexError, TypeError):
+                Domoticz.Error("Discovery message has no device identifier, ignored: "+Topic)
+                outcomes["failed"] += 1
+
+        for deviceID in theDevices:
+            theDevice = self.deviceMappings.get(deviceID)
+            nextUnit = max(theDevice.units) + 1 if (theDevice != None) and (len(theDevice.units) > 0) else 1
+            newUnits = []
+            for Topic in theDevices[deviceID]:
+                jsonDict, fingerprint, clientID = theBatch[Topic]
+                try:
+                    outcome = self.discoverEntity(Topic, jsonDict, deviceID, nextUnit, clientID, newUnits)
+                    if (outcome == "created"):
+                        nextUnit += 1
+                    if (outcome != "failed"):
+                        self.discoveryFingerprints[Topic] = fingerprint
+                    outcomes[outcome] += 1
+                except:
+                    exc_type, exc_obj, tb = sys.exc_info()
+                    Domoticz.Error("Unexpected error: " + str(sys.exc_info()[0])+" at line: "+str(tb.tb_lineno))
+                    Domoticz.Dump()
+                    outcomes["failed"] += 1
+
+            # Create the matching Domoticz DeviceStatus entries together then route their topics
+            for newUnit, stateTopic in newUnits:
+                if (newUnit != None):
+                    if (deviceID in self.batteryLevels): newUnit.BatteryLevel = self.batteryLevels[deviceID]
+                    newUnit.Create()
+                    self.log.debug("New created device: '{}', DeviceID: '{}', Unit: {}", newUnit.Name, deviceID, newUnit.Unit)
+            for newUnit, stateTopic in newUnits:
+                self.routeTopic(stateTopic)
+            outcomes["devices"] += 1
+        return outcomes
+
+    def discoverEntity(self, Topic, jsonDict, deviceID, unitNum, clientID, newUnits):
+        # Map one discovered entity, a Domoticz unit it needs (or None at device level) is added to 'newUnits' with its
+        # state topic for the caller to create and route
+        mqttDict = jsonDict["device"]
+
+        # If the topic is already handled just make sure the stored details are current
+        stateTopic = jsonDict["state_topic"]
+        if (stateTopic in self.removedTopics):
+            # Only new or changed discovery gets this far, the gateway wants the unit back
+            self.removedTopics.discard(stateTopic)
+            self.log.debug("{} belonged to a removed unit, discovered again", stateTopic)
+        theMapping = self.topicMappings.get(stateTopic)
+        if (theMapping != None) and (theMapping.deviceID == deviceID):
+            self.tagDevice(deviceID, clientID)
+            if (self.storeDiscoveryDetails(theMapping, jsonDict)):
+                self.log.debug("Discovery details changed for {}, mapping against {}\\{} updated", stateTopic, deviceID, theMapping.unitNum)
+                self.markConfigDirty()
+                self.routeTopic(stateTopic)
+                return "updated"
+            self.log.debug("{} is already mapped against {}\\{}", stateTopic, deviceID, theMapping.unitNum)
+            return "unchanged"
+
+        # Topic not handled so might need to create if we should handle it
+        # Device type is in the topic name
+        # domoticz/sensor/Bedside_Lamp/electric_kwh_value/config
+        topicList = Topic.split('/')
+        if (len(topicList) != 5):
+            Domoticz.Error("Incorrect topic structure, device not created: "+Topic)
+            return "failed"
+        typeName = self.typeMapping[topicList[3]]["type"] if topicList[3] in self.typeMapping else None
+
+        # This is new so consider:
+        #   1.  Should this be a new Unit?
+        #   2.  Is this of Device level interest?
+        #   3.  Otherwise ignore it
+        if (typeName == None) and (not topicList[3] in self.specialHandling):
+            self.log.debug("{} ignored", stateTopic)
+            return "ignored"
+
+        #   1.  Should this be a new Unit (numbered by the caller)?
+        #   2.  Otherwise it is of Device level interest (unit 0)
+        if (typeName == None):
+            unitNum = 0
+
+        # Add known details
+        theMapping = UnitMapping(deviceID, unitNum, sys.intern(topicList[3]), sys.intern(topicList[1]))
+        self.storeDiscoveryDetails(theMapping, jsonDict)
+        self.tagDevice(deviceID, clientID)
+
+        # Update the persistent configuration (written on the next heartbeat)
+        self.markConfigDirty()
+
+        if (typeName == None):
+            newUnits.append((None, stateTopic))     # Routed once the device's units exist
+            Domoticz.Debug("'"+topicList[3]+"' is not a mapped type, device not created: "+Topic)
+            return "device"
+
+        name = jsonDict["name"]
+        # If there is Domoticz type name then use that in the name rather than the supplied one
+        if (name.find(theMapping.mappedType) > -1): 
+            if (topicList[3] in self.typeMapping) and ("suffix" in self.typeMapping[topicList[3]]):
+                suffix = self.typeMapping[topicList[3]]["suffix"]
+                name = name.replace("_"+topicList[3], " "+suffix)
+                if (not isinstance(typeName, tuple)): 
                     name = name.replace(typeName+" "+typeName, typeName)
+            elif (not isinstance(typeName, tuple)): 
+                name = name.replace("_"+topicList[3], " "+typeName)
+                name = name.replace(typeName+" "+typeName, typeName)
 
-            description = mqttDict["manufacturer"]+" - "+mqttDict["model"]
+        description = mqttDict["manufacturer"]+" - "+mqttDict["model"]
 
-            sValue = self.typeMapping[topicList[3]]["defaultSvalue"] if "defaultSvalue" in self.typeMapping[topicList[3]] else ""
-
-            if (not isinstance(typeName, tuple)): 
-                # New device: 'Lava Lamp_electric_kwh_value', DeviceID: 'zwavejs2mqtt_0xe0779f52_node6', Description: 'AEON Labs - Smart Switch 6 (ZW096)'
-                newUnit = Domoticz.Unit(Name=name, DeviceID=deviceID, Unit=int(unitNum), TypeName=typeName, Description=description)
-            else:
-                mainType, subType, switchType = typeName
-                newUnit = Domoticz.Unit(Name=name, DeviceID=deviceID, Unit=int(unitNum), Type=mainType, Subtype=subType, Switchtype=switchType , Description=description)
-            newUnit.sValue = sValue
-            newUnit.Create()
+        sValue = self.typeMapping[topicList[3]]["defaultSvalue"] if "defaultSvalue" in self.typeMapping[topicList[3]] else ""
 
-            Domoticz.Log("New created device: '"+name+"', DeviceID: '"+deviceID+"', Description: '"+description+"'")
-        except:
-            exc_type, exc_obj, tb = sys.exc_info()
-            Domoticz.Error("Unexpected error: " + str(sys.exc_info()[0])+" at line: "+str(tb.tb_lineno))
-            Domoticz.Dump()
+        if (not isinstance(typeName, tuple)): 
+            # New device: 'Lava Lamp_electric_kwh_value', DeviceID: 'zwavejs2mqtt_0xe0779f52_node6', Description: 'AEON Labs - Smart Switch 6 (ZW096)'
+            newUnit = Domoticz.Unit(Name=name, DeviceID=deviceID, Unit=unitNum, TypeName=typeName, Description=description)
+        else:
+            mainType, subType, switchType = typeName
+            newUnit = Domoticz.Unit(Name=name, DeviceID=deviceID, Unit=unitNum, Type=mainType, Subtype=subType, Switchtype=switchType , Description=description)
+        newUnit.sValue = sValue
+        newUnits.append((newUnit, stateTopic))
+        return "created"
+
+    def markConfigDirty(self):
+        if (self.configDirty):
+            self.configWritesSaved += 1
+        self.configDirty = True
+
+    def flushConfig(self):
+        if (self.configDirty):
+            Domoticz.Configuration(self.configurationToSave())
+            self.configDirty = False
+            Domoticz.Debug("Configuration saved, "+str(self.configWritesSaved)+" writes avoided so far.")
+
+    def reportUnmapped(self):
+        # One line for all the messages dropped since the last report instead of one per message
+        # Topics in 'completelyIgnore' are never logged, they only appear at debug level
+        dropped = [topic for topic in self.unmappedTopics if (self.unmappedTopics[topic] > 0)]
+        if (len(dropped) == 0):
+            return
+        ignored = [topic for topic in dropped if (topic[topic.rfind('/')+1:] in self.completelyIgnore)]
+        if (len(ignored) > 0):
+            self.log.debug("Ignored topics: {} messages dropped on {} topics", sum(self.unmappedTopics[topic] for topic in ignored), len(ignored))
+            for topic in ignored:
+                self.unmappedTopics[topic] = 0
+            dropped = [topic for topic in dropped if (self.unmappedTopics[topic] > 0)]
+            if (len(dropped) == 0):
+                return
+        dropped.sort(key=lambda topic: -self.unmappedTopics[topic])
+        total = sum(self.unmappedTopics[topic] for topic in dropped)
+        busiest = ", ".join([topic+" ("+str(self.unmappedTopics[topic])+")" for topic in dropped[:5]])
+        self.log.log("Unmapped topics: {} messages dropped on {} topics, busiest: {}", total, len(dropped), busiest)
+        for topic in dropped:
+            self.unmappedTopics[topic] = 0
+
+    def pruneGateways(self, deviceCounts):
+        # Forget gateways that are not connected, own no devices and hold no session
+        for clientID in [clientID for clientID in self.gateways if (deviceCounts[clientID] == 0)]:
+            theGateway = self.gateways[clientID]
+            if (theGateway.connection == None) and (not theGateway.sessionStored):
+                del self.gateways[clientID]
+                self.log.debug("Gateway '{}' forgotten, it owns no devices", clientID)
+
+    def reportGateways(self):
+        # Per gateway statistics, logged when more than one gateway has been seen
+        deviceCounts = collections.Counter([theDevice.clientID for theDevice in self.deviceMappings.values()])
+        self.pruneGateways(deviceCounts)
+        theGateways = {}
+        for clientID in self.gateways:
+            theGateway = self.gateways[clientID]
+            theGateways[clientID] = theGateway.snapshot(deviceCounts[clientID])
+            if (len(self.gateways) > 1):
+                Domoticz.Log("Gateway '"+clientID+"' ("+", ".join(sorted(theGateway.homeIDs))+"): "+("connected" if (theGateway.connection != None) else "not connected")+
+                             ", devices: "+str(deviceCounts[clientID])+", received: "+str(theGateway.received)+", discovery: "+str(theGateway.discovery)+
+                             ", commands: "+str(theGateway.commands)+", dropped: "+str(theGateway.dropped)+
+                             (", held for its session: "+str(len(theGateway.pending)) if (theGateway.sessionStored) else ""))
+        return theGateways
+
+    def reportMetrics(self):
+        theSummary = self.metrics.summary()
+        Domoticz.Log("Plugin metrics: "+theSummary)
+        if (self.pipelineWorker != None):
+            Domoticz.Log("Pipeline: queued: "+str(self.metrics.counters.get("pipeline.queued", 0))+", dropped: "+str(self.metrics.counters.get("pipeline.dropped", 0))+
+                         ", backlog: "+str(self.pipelinePending)+", peak backlog: "+str(self.pipelinePeak))
+        self.reportUnmapped()
+        if (self.metricsDeviceID in Devices) and (1 in Devices[self.metricsDeviceID].Units):
+            theUnit = Devices[self.metricsDeviceID].Units[1]
+            theUnit.sValue = theSummary
+            theUnit.Update()
+        theSnapshot = self.metrics.snapshot()
+        theSnapshot["gateways"] = self.reportGateways()
+        try:
+            with open(Parameters["HomeFolder"]+"Plugin Metrics.json", "w") as metricsFile:
+                json.dump(theSnapshot, metricsFile, indent=2)
+        except OSError as err:
+            Domoticz.Error("Unable to write plugin metrics: "+str(err))
+        if (self.log.debugging):
+            self.dumpHistory()
+
+    def startPipeline(self):
+        self.pipelineQueue = queue.Queue(self.pipelineSize)
+        self.pipelineResults = queue.Queue()
+        self.pipelineWorker = threading.Thread(name="Zwavejs2Mqtt pipeline", target=self.pipelineDecode, daemon=True)
+        self.pipelineWorker.start()
+        self.setHeartbeat()
+        Domoticz.Log("Pipeline mode enabled, queue size: "+str(self.pipelineSize))
+
+    def stopPipeline(self):
+        if (self.pipelineWorker == None):
+            return
+        self.pipelineQueue.put(None)
+        self.pipelineWorker.join(5)
+        self.pipelineWorker = None
+        self.drainPipeline()
+        Domoticz.Log("Pipeline stopped, peak backlog: "+str(self.pipelinePeak)+", dropped: "+str(self.metrics.counters.get("pipeline.dropped", 0)))
+
+    def pipelineDecode(self):
+        # Worker thread, must not call Domoticz or touch units. Routes are only read, the plugin thread checks they are current.
+        # Change detection is against the worker's own snapshot, topic -> (route, time, hasValue, value) of the newest event
+        # seen. A result carries the time of the previous event when the value has not changed, the plugin thread only
+        # trusts it if that event is the one it last applied to the route
+        theSnapshot = {}
+        while True:
+            theItem = self.pipelineQueue.get()
+            if (theItem == None):
+                return
+            Topic, Payload = theItem
+            theRoute = self.topicRoutes.get(Topic)
+            theEvent = None
+            unchangedSince = None
+            if (theRoute != None):
+                try:
+                    theEvent = DecodeTimeValue(Payload)
+                except Exception:
+                    pass        # Decoded again on the plugin thread which reports the error
+            if (theEvent != None) and (theEvent.time != None):
+                previous = theSnapshot.get(Topic)
+                if (previous == None) or (previous[0] is not theRoute) or (theEvent.time >= previous[1]):
+                    if (previous != None) and (previous[0] is theRoute) and (previous[2] == theEvent.hasValue) and \
+                            (type(previous[3]) is type(theEvent.value)) and (previous[3] == theEvent.value):
+                        unchangedSince = previous[1]
+                    theSnapshot[Topic] = (theRoute, theEvent.time, theEvent.hasValue, theEvent.value)
+            self.pipelineResults.put((Topic, Payload, theRoute, theEvent, unchangedSince))
+
+    def queueData(self, Topic, Payload):
+        # Never waits, a full queue drops the message
+        try:
+            self.pipelineQueue.put_nowait((Topic, Payload))
+        except queue.Full:
+            self.metrics.count("pipeline.dropped")
+            self.log.unitLog("pipeline", "Pipeline queue full, state message dropped for: {}", Topic)
+            return
+        self.pipelinePending += 1
+        if (self.pipelinePending > self.pipelinePeak): self.pipelinePeak = self.pipelinePending
+        self.metrics.count("pipeline.queued")
+
+    def drainPipeline(self, limit=None):
+        # Apply the worker results already waiting, never waits for the worker. The rest are applied by a later callback
+        applied = 0
+        while (self.pipelinePending > 0) and ((limit == None) or (applied < limit)):
+            try:
+                Topic, Payload, theRoute, theEvent, unchangedSince = self.pipelineResults.get_nowait()
+            except queue.Empty:
+                break
+            self.pipelinePending -= 1
+            applied += 1
+            started = time.perf_counter()
+            self.synchroniseData(Topic, Payload, theRoute, theEvent, unchangedSince)
+            self.metrics.timing("synchroniseData", time.perf_counter()-started)
 
     def onStart(self):
         if Parameters["Mode6"] == "Debug":
             Domoticz.Debugging(1)
+            self.log.debugging = True
         if Parameters["Mode5"] == "True":
-            self.mqttLogFile = open(Parameters["HomeFolder"]+"MQTT Messages.log","a")
+            self.mqttCapture = MessageCapture(Parameters["HomeFolder"]+"MQTT Messages.jsonl", **self.captureSettings)
         DumpConfigToLog()
 
         # load the existing configuration
-        self.pluginConfig = Domoticz.Configuration()
+        self.loadConfiguration(Domoticz.Configuration())
+        self.reconcileDevices()
+        self.buildRoutes()
+
+        self.loadLastValues()
+
+        # Plugin owned device to show the metrics in the UI, if the user deletes it it stays deleted until restart
+        if (not self.metricsDeviceID in Devices):
+            Domoticz.Unit(Name="Plugin Metrics", DeviceID=self.metricsDeviceID, Unit=1, TypeName="Text", Description="Message handling statistics").Create()
 
         # set up the listener
         Protocol = "MQTT"
@@ -620,25 +2078,48 @@ class BasePlugin:
         self.mqttListener = Domoticz.Connection(Name="ZWave2MQTT", Transport="TCP/IP", Protocol=Protocol, Address=Parameters["Address"], Port=Parameters["Port"])
         self.mqttListener.Listen()
 
+        if (Parameters["Mode4"] == "True"):
+            self.startPipeline()
+
     def onStop(self):
-        if (self.mqttLogFile != None):
-            self.mqttLogFile.close()
+        self.stopPipeline()
+        self.flushDiscovery(True)
+        self.flushCommands(True)
+        self.flushAggregates(True)
+        self.flushMeters(True)
+        self.flushConfig()
+        self.saveLastValues()
+        self.reportMetrics()
+        Domoticz.Log("Configuration writes avoided by write-behind: "+str(self.configWritesSaved))
+        if (self.mqttCapture != None):
+            self.mqttCapture.close()
+            Domoticz.Log("MQTT capture closed, "+str(self.mqttCapture.captured)+" messages written.")
 
     def onConnect(self, Connection, Status, Description):
         if (Status == 0):
             Domoticz.Debug("MQTT connected successfully.")
             self.mqttClients[Connection.Address+":"+Connection.Port] = Connection
+            self.clientActivity[Connection.Address+":"+Connection.Port] = [time.monotonic(), None]
         else:
             Domoticz.Log("Failed to connect ("+str(Status)+") to: "+Parameters["Address"]+":"+Parameters["Port"]+" with error: "+Description)
 
     def onMessage(self, Connection, Data):
+        self.flushCommands()
+        self.flushDiscovery()
         if (isinstance(Data, dict)) and ("Verb" in Data):
-            Domoticz.Debug("onMessage called with: "+Data["Verb"])
+            self.log.debug("onMessage called with: {}", Data["Verb"])
+            self.metrics.count("verb."+Data["Verb"])
+            theActivity = self.clientActivity.get(Connection.Address+":"+Connection.Port)
+            if (theActivity != None): theActivity[0] = time.monotonic()
             #DumpDictionaryToLog(Data)
             if (Data["Verb"] == "CONNECT"):
                 reasonCode = 0  # Success
                 reasonString = "Success"
-                sessionPresent = True
+                sessionPresent = False
+                mqttConn = Connection.Address+":"+Connection.Port
+                # Without a client ID the connection stands in for it so clients on the same host stay apart. It cannot have a session
+                anonymous = (not "ClientIdentifier" in Data) or (len(Data["ClientIdentifier"]) == 0)
+                clientID = mqttConn if (anonymous) else Data["ClientIdentifier"]
                 if (Data["Version"] > 4):
                     Domoticz.Error("MQTT Client is using an unacceptable protocol version")
                     reasonCode = 1  # Success
@@ -651,35 +2132,53 @@ class BasePlugin:
                     reasonCode = 4  # Authentication fail
                     reasonString = "Connection Refused, bad user name or password"
                     sessionPresent = False
+                else:
+                    if (anonymous): self.anonymousClients.add(clientID)
+                    sessionPresent = self.connectGateway(mqttConn, clientID, Data["CleanSession"] if ("CleanSession" in Data) and (not anonymous) else True)
+                    if (mqttConn in self.clientActivity): self.clientActivity[mqttConn][1] = Data["KeepAlive"] if ("KeepAlive" in Data) else 0
                 Connection.Send({"Verb":"CONNACK",
                                  "SessionPresent":sessionPresent, 
                                  "ReasonCode":reasonCode,     # https://docs.oasis-open.org/mqtt/mqtt/v5.0/os/mqtt-v5.0-os.html#_Toc3901079
                                  #"SessionExpiryInterval":3600,
                                  "MaximumQoS":1,
-                                 "RetainAvailable":False,
+                                 "RetainAvailable":True,
                                  "MaximumPacketSize":4096,
                                  #"AssignedClientID":None,
                                  "ReasonString":reasonString,
                                  "ResponseInformation":"Domoticz"})
                 if (reasonCode == 0):
-                    Domoticz.Log("MQTT Connection: "+reasonString)
+                    Domoticz.Log("MQTT Connection: "+reasonString+", client '"+clientID+"' from "+mqttConn+(", resuming session" if (sessionPresent) else ""))
+                    if (sessionPresent): self.resumeSession(mqttConn, clientID)
                 else:
-                    if (Connection.Address+":"+Connection.Port in self.mqttClients):
-                        self.mqttClients.pop(Connection.Address+":"+Connection.Port,None)
+                    self.forgetClient(mqttConn)
             elif (Data["Verb"] == "PUBLISH"):
                 node = None
                 try:
                     if (Data["QoS"] == 1):
                         Connection.Send({"Verb":"PUBACK", "ReasonCode":  0, "PacketIdentifier":Data["PacketIdentifier"], "ReasonString":"Success"})
                     
-                    if (self.mqttLogFile != None):
-                        self.mqttLogFile.write(Data["Topic"]+": "+str(Data["Payload"])+"\n")
+                    if (self.mqttCapture != None):
+                        self.mqttCapture.capture(Connection.Address+":"+Connection.Port, Data["Topic"], Data["QoS"], Data["Payload"])
+
+                    if ("Retain" in Data) and (Data["Retain"]):
+                        self.retainMessage(Data["Topic"], Data["Payload"], Data["QoS"])
+
+                    clientID = self.clientIDs.get(Connection.Address+":"+Connection.Port)
+                    if (clientID != None): self.gateways[clientID].received += 1
 
                     if (Data["Topic"][:8] == "domoticz"):
-                        self.synchroniseDevice(Data["Topic"], Data["Payload"])
+                        self.metrics.count("topic.discovery")
+                        if (clientID != None): self.gateways[clientID].discovery += 1
+                        started = time.perf_counter()
+                        self.synchroniseDevice(Data["Topic"], Data["Payload"], clientID)
+                        self.metrics.timing("synchroniseDevice", time.perf_counter()-started)
 
                     if (Data["Topic"][:5] == "zwave"):
-                        self.synchroniseData(Data["Topic"], Data["Payload"])
+                        self.metrics.count("topic.data")
+                        if (Data["Topic"] in self.discoveryPending):
+                            self.holdData(Data["Topic"], Data["Payload"])
+                        else:
+                            self.handleData(Data["Topic"], Data["Payload"])
 
                 except json.JSONDecodeError:
                     if (Data["QoS"] == 1):
@@ -690,8 +2189,7 @@ class BasePlugin:
                     exc_type, exc_obj, tb = sys.exc_info()
                     Domoticz.Error("Unexpected error: " + str(sys.exc_info()[0])+" at line: "+str(tb.tb_lineno))
                     Domoticz.Dump()
-                    if (Connection.Address+":"+Connection.Port in self.mqttClients):
-                        self.mqttClients.pop(Connection.Address+":"+Connection.Port,None)
+                    self.forgetClient(Connection.Address+":"+Connection.Port)
             elif (Data["Verb"] == "SUBSCRIBE"):
                 # MQTT2ZWave Subscription, Payload: 
                 # {
@@ -707,38 +2205,79 @@ class BasePlugin:
                 #       ]
                 # }
                 #Domoticz.Log("MQTT2ZWave Subscription, Payload: "+str(Data))
-                Connection.Send({"Verb":"SUBACK", "PacketIdentifier":Data["PacketIdentifier"], "QoS":0 })
+                mqttConn = Connection.Address+":"+Connection.Port
+                theGateway = self.gateways.get(self.clientIDs.get(mqttConn))
+                grantedTopics = []
+                retainedFilters = []
+                for theTopic in Data["Topics"]:
+                    if (SubscriptionTree.validFilter(theTopic["Topic"])):
+                        grantedQoS = min(theTopic["QoS"] if ("QoS" in theTopic) else 0, 1)     # Maximum QoS is 1 (see CONNACK)
+                        self.subscriptions.subscribe(mqttConn, theTopic["Topic"], grantedQoS)
+                        if (theGateway != None): theGateway.subscriptions[theTopic["Topic"]] = grantedQoS
+                        retainedFilters.append((theTopic["Topic"], grantedQoS))
+                    else:
+                        Domoticz.Error("Invalid subscription topic filter from "+mqttConn+": "+theTopic["Topic"])
+                        grantedQoS = 0x80   # Failure
+                    grantedTopics.append({"Topic":theTopic["Topic"], "QoS":grantedQoS})
+                    self.log.debug("Subscription from {}: {}, QoS {}", mqttConn, theTopic["Topic"], grantedQoS)
+                Connection.Send({"Verb":"SUBACK", "PacketIdentifier":Data["PacketIdentifier"], "QoS":grantedTopics[0]["QoS"] if (len(grantedTopics) > 0) else 0, "Topics":grantedTopics })
+                for topicFilter, grantedQoS in retainedFilters:
+                    self.deliverRetained(mqttConn, topicFilter, grantedQoS)
+            elif (Data["Verb"] == "UNSUBSCRIBE"):
+                mqttConn = Connection.Address+":"+Connection.Port
+                theGateway = self.gateways.get(self.clientIDs.get(mqttConn))
+                for theTopic in Data["Topics"]:
+                    topicFilter = theTopic["Topic"] if (isinstance(theTopic, dict)) else theTopic
+                    self.subscriptions.unsubscribe(mqttConn, topicFilter)
+                    if (theGateway != None): theGateway.subscriptions.pop(topicFilter, None)
+                    self.log.debug("Unsubscribed {} from {}", mqttConn, topicFilter)
+                Connection.Send({"Verb":"UNSUBACK", "PacketIdentifier":Data["PacketIdentifier"]})
             elif (Data["Verb"] == "PINGREQ"):
                 Connection.Send({"Verb":"PINGRESP"})
-                Domoticz.Debug("Responded to PING: "+Data["Verb"])
+                self.log.debug("Responded to PING: {}", Data["Verb"])
             elif (Data["Verb"] == "PUBACK"):
-                Domoticz.Debug("PUBACK received: "+str(Data))
+                self.log.debug("PUBACK received: {}", Data)
+                self.acknowledgePublish(Connection.Address+":"+Connection.Port, Data["PacketIdentifier"])
             else:
                 Domoticz.Error("Unhandled message type: "+str(Data))
         else:
             Domoticz.Error("onMessage: '"+Connection.Address+":"+Connection.Port+"' send data that was not a dictionary or no Verb was present")
-            if (Connection.Address+":"+Connection.Port in self.mqttClients):
-                self.mqttClients.pop(Connection.Address+":"+Connection.Port,None)
+            self.forgetClient(Connection.Address+":"+Connection.Port)
+        if (self.pipelineWorker != None):
+            self.drainPipeline(self.pipelineBatch)
 
     def onDisconnect(self, Connection):
         Domoticz.Log("onDisconnect called for:"+Connection.Address+":"+Connection.Port)
-        if (Connection.Address+":"+Connection.Port in self.mqttClients):
-            self.mqttClients.pop(Connection.Address+":"+Connection.Port,None)
+        self.forgetClient(Connection.Address+":"+Connection.Port)
 
     def onHeartbeat(self):
         Domoticz.Debug("onHeartbeat called: "+str(self.counter))
+        self.counter += 1
+        if (self.pipelineWorker != None):
+            self.drainPipeline()
+        if (time.monotonic() - self.lastMetrics >= self.metricsInterval):
+            self.lastMetrics = time.monotonic()
+            self.reportMetrics()
+        self.flushDiscovery()
+        self.flushAggregates()
+        self.flushMeters()
+        self.flushConfig()
+        self.flushCommands()
+        self.reapClients()
+        self.retransmitPublishes()
+        if (self.mqttCapture != None):
+            self.mqttCapture.flush()
 
     def onDeviceRemoved(self, DeviceID, Unit):
         Domoticz.Log("onDeviceRemoved called: "+str(DeviceID)+", "+str(Unit))
 
-        # Remove from lookup
-
-        # Remove from device/unit list
-
-        # Was it the last Unit for the Device? Remove the Device?
+        # Remove from the lookups and device/unit list, messages for its topics are dropped from now on
+        if (not self.removeUnit(DeviceID, Unit)):
+            Domoticz.Debug(str(DeviceID)+"\\"+str(Unit)+" is not in the plugin configuration.")
 
     def onCommand(self, DeviceID, Unit, Command, Level, Hue):
         Domoticz.Debug("onCommand called: "+DeviceID+"\\"+str(Unit)+", Command: "+Command)
+        self.flushCommands()
 
         theType = self.typeFromConfiguration(DeviceID, Unit)
         if (theType == None): return
@@ -796,6 +2335,67 @@ def onStop():
     _plugin.onStop()
 
 # Generic helper functions
+def Utf8(Payload):
+    return Payload.decode("utf-8", "replace") if isinstance(Payload, (bytes, bytearray)) else str(Payload)
+
+def HomeID(DeviceID):
+    # 'zwavejs2mqtt_0xe0779f52_node5' -> '0xe0779f52', the Z-Wave network the device belongs to
+    parts = DeviceID.split("_")
+    return parts[1] if (len(parts) == 3) and (parts[2][:4] == "node") else None
+
+# JSON's number grammar, no leading zeros and digits both sides of any '.' or exponent
+JsonNumber = re.compile(rb'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?')
+
+def JsonInteger(Text):
+    # Digits only with no leading zero (other than '0' itself), optionally negative
+    digits = Text[1:] if (Text[:1] == b'-') else Text
+    return (digits.isdigit()) and ((digits[:1] != b'0') or (len(digits) == 1))
+
+def DecodeTimeValue(Payload):
+    # zwavejs2mqtt's 'JSON Time-Value' payloads are almost always b'{"time":<int>,"value":<scalar>}' so pick
+    # those apart directly, anything else (colours, extra keys, escaped strings) goes through json.loads
+    if (isinstance(Payload, (bytes, bytearray))) and (Payload[:8] == b'{"time":') and (Payload[-1:] == b'}'):
+        separator = Payload.find(b',"value":', 8)
+        # Anything json.loads would reject (such as leading zeros or '5.') is left for it to reject
+        if (separator == -1):
+            timeText = Payload[8:-1]
+            if (timeText.isdigit()) and (JsonInteger(timeText)):
+                return TimeValue(int(timeText), None, False)
+        else:
+            timeText = Payload[8:separator]
+            valueText = Payload[separator+9:-1]
+            if (timeText.isdigit()) and (JsonInteger(timeText)) and (len(valueText) > 0):
+                first = valueText[:1]
+                try:
+                    if (first in b'-0123456789'):
+                        if (JsonInteger(valueText)):
+                            return TimeValue(int(timeText), int(valueText), True)
+                        if (JsonNumber.fullmatch(valueText) != None):
+                            return TimeValue(int(timeText), float(valueText), True)
+                    elif (valueText == b'true'):
+                        return TimeValue(int(timeText), True, True)
+                    elif (valueText == b'false'):
+                        return TimeValue(int(timeText), False, True)
+                    elif (valueText == b'null'):
+                        return TimeValue(int(timeText), None, True)
+                    elif (first == b'"') and (valueText.count(b'"') == 2) and (valueText[-1:] == b'"') and (valueText.find(b'\\') == -1):
+                        return TimeValue(int(timeText), valueText[1:-1].decode("utf-8"), True)
+                except (ValueError, UnicodeDecodeError):
+                    pass
+
+    jsonDict = json.loads(Payload)
+    if (not isinstance(jsonDict, dict)):
+        return TimeValue(None, jsonDict, True)
+    theTime = jsonDict.get("time")
+    return TimeValue(int(theTime) if (theTime != None) else None, jsonDict.get("value"), ("value" in jsonDict))
+
+def LastUpdateToMillis(LastUpdate):
+    # Unit LastUpdate ('2021-09-23 15:44:28', local time) as epoch milliseconds
+    try:
+        return int(time.mktime(time.strptime(str(LastUpdate), "%Y-%m-%d %H:%M:%S")))*1000
+    except (ValueError, OverflowError):
+        return 0
+
 def DumpConfigToLog():
     for x in Parameters:
         if Parameters[x] != "":